@@ -2,22 +2,72 @@
 # requires-python = ">=3.11"
 # dependencies = []
 # ///
-"""Clean AI-assistant config dirs and Claude Desktop bloat; VACUUM+REINDEX any SQLite DBs found.
+"""Clean AI-assistant config dirs and Claude Desktop bloat; compact bloated SQLite DBs.
 
 Usage:
-    uv run cleanup.py [--dry-run] [--verbose] [--force] [--days N] [--desktop-only] [--generic-only]
+    uv run cleanup.py [--dry-run] [--verbose] [--force] [--days N] [--jobs N]
+                      [--db-jobs N] [--vacuum-threshold R] [--optimize]
+                      [--vacuum-into] [--log-lines N] [--log-max-bytes SIZE]
+                      [--manifest PATH] [--format text|ndjson|json]
+                      [--profile] [--trace-out PATH] [--cprofile-out PATH]
+                      [--max-size [DIR=]SIZE]... [--protect GLOB]...
+                      [--archive DIR [--archive-format gz|xz] [--archive-keep N]]
+                      [--dedupe [auto|reflink|hardlink]] [--rules TOML]
+                      [--cache-days N] [--cache-budget SIZE]
+                      [--trash [DIR]] [--trash-keep HOURS] [--undo] [--purge-trash]
+                      [--max-io-rate SIZE] [--max-ops-rate N] [--low-priority]
+                      [--max-seconds S] [--compact-transcripts DAYS]
+                      [--gzip-transcripts DAYS] [--payload-limit SIZE]
+                      [--journal [DIR]] [--journal-max-age HOURS]
+                      [--watch [--watch-max-size SIZE] [--watch-debounce S]]
+                      [--homes GLOB]... [--fleet-jobs N]
+                      [--desktop-only] [--generic-only]
     uv run cleanup.py --self-check
 """
 
 from __future__ import annotations
 
 import argparse
+import cProfile
+import ctypes
+import errno
+import fnmatch
+import functools
+import glob
+import gzip
+import hashlib
+import heapq
+import json
+import lzma
+import math
+import os
+import re
+import select
 import shutil
 import sqlite3
+import stat
+import struct
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import tomllib
+from collections import deque
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
 from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, NamedTuple, Self, TextIO
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator
 
 GENERIC_DIRS = (".claude", ".gemini", ".copilot", ".qwen", ".cursor", ".opencode")
 JUNK_SUFFIXES = (".log", ".log.gz", ".log.old", ".tmp", ".temp", ".cache")
@@ -42,14 +92,794 @@ DESKTOP_DBS = (
     "WebStorage/QuotaManager",
 )
 DESKTOP_DISABLED_EXTENSION = "Claude Extensions/ant.dir.gh.anthropic.pdf-server-mcp"
+DESKTOP_EXTENSIONS = "Claude Extensions"
+# Chromium Simple Cache: one "<hash>_0/_1/_s" file set per entry, plus an index.
+SIMPLE_ENTRY_RE = re.compile(r"([0-9a-f]{16})_[01s]|todelete_[0-9a-f]+")
+SIMPLE_INDEX = "index-dir/the-real-index"
+SIMPLE_INDEX_MAGIC = 0x656E74657220796F
+SIMPLE_INDEX_VERSIONS = (7, 8, 9)
+# Pickle header (size, crc), then magic, version, entry count, cache size, reason.
+_SIMPLE_INDEX_HEADER = struct.Struct("<IIQIQQI")
+_SIMPLE_INDEX_ENTRY = struct.Struct("<QqQ")
+# base::Time counts microseconds from 1601-01-01.
+_CHROME_EPOCH_OFFSET = 11644473600
+DESKTOP_PROCESS_NAMES = frozenset({"Claude", "claude"})
+SQLITE_SIDE_SUFFIXES = ("-wal", "-shm", "-journal")
+
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+DEFAULT_DB_JOBS = min(4, os.cpu_count() or 1)
+DEFAULT_FLEET_JOBS = min(4, os.cpu_count() or 1)
+DEFAULT_VACUUM_THRESHOLD = 0.10
+DEFAULT_LOG_LINES = 100
+LOG_BLOCK = 64 * 1024
+MANIFEST_RACY_SECONDS = 2.0
+AUTO_VACUUM_INCREMENTAL = 2
+UNLINK_BATCH = 256
+# Config and state that a size quota never evicts, on top of --protect.
+DEFAULT_QUOTA_PROTECT = (
+    "*.json",
+    "*.toml",
+    "*.md",
+    ".credentials*",
+    *(f"*{suffix}" for suffix in DB_SUFFIXES),
+)
+# Disposable junk is deleted even in archive mode; everything else is kept.
+ARCHIVE_SKIP_SUFFIXES = (".tmp", ".temp", ".cache")
+# Stored as-is in archives: compressing these again costs CPU and saves nothing.
+COMPRESSED_SUFFIXES = (".gz", ".xz", ".bz2", ".zst", ".lz4", ".zip", ".7z", ".br")
+ARCHIVE_FORMATS = ("gz", "xz")
+DEFAULT_ARCHIVE_KEEP = 10
+ARCHIVE_SPOOL = 8 * 1024**2
+ARCHIVE_SYNC_BYTES = 64 * 1024**2
+DEDUPE_MODES = ("auto", "reflink", "hardlink")
+# Smaller files are not worth a hash and an extra inode operation.
+DEDUPE_MIN_SIZE = 4096
+DEDUPE_BLOCK = 64 * 1024
+# Live databases and credentials must never share storage with another file.
+DEDUPE_SKIP_SUFFIXES = DB_SUFFIXES + SQLITE_SIDE_SUFFIXES
+DEDUPE_SKIP_PREFIXES = (".credentials",)
+FICLONE = 0x40049409  # <linux/fs.h> _IOW(0x94, 9, int)
+# Relative to home, like everything kept between runs.
+STATE_DIR = Path(".local/share/claude-cleanup")
+# Must share a filesystem with what it stages for a stage to stay one rename.
+DEFAULT_TRASH_DIR = STATE_DIR / "trash"
+COST_MODEL = STATE_DIR / "costs.json"
+DEFAULT_JOURNAL_DIR = STATE_DIR / "journal"
+DEFAULT_JOURNAL_MAX_AGE = 6.0
+JOURNAL_VERSION = 1
+JOURNAL_BATCH = 1024
+JOURNAL_FLUSH_SECONDS = 1.0
+PLAN_BATCH = 1024
+# Deleter jobs per worker the executor lets pile up before it stops planning.
+PIPELINE_DEPTH = 8
+# Seconds per unit of work before any run has been measured: per entry for
+# delete and clear, per file byte for vacuum, per byte moved for truncate.
+DEFAULT_COSTS = {
+    "delete": 3e-5,
+    "clear": 3e-5,
+    "vacuum": 2e-8,
+    "truncate": 5e-9,
+    "compact": 1e-8,
+    "dedupe": 2e-9,
+}
+COST_OVERHEAD = 0.002
+COST_SMOOTHING = 0.3
+DEFAULT_TRASH_KEEP = 24.0
+TRASH_INDEX = "index.jsonl"
+LOW_NICE = 19
+# ioprio_set(2) has no libc wrapper; its syscall number differs per architecture.
+IOPRIO_SET_NR = {
+    "x86_64": 251,
+    "i686": 289,
+    "aarch64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+# SQLite VM steps between throttle checks while a VACUUM runs.
+THROTTLE_SQLITE_STEPS = 10_000
+TRANSCRIPT_SUFFIX = ".jsonl"
+DEFAULT_PAYLOAD_LIMIT = 16 * 1024
+PAYLOAD_NOTE_ROOM = 48
+# What a budgeted run expects compaction to save, before reading anything.
+COMPACT_GUESS = 0.5
+DEFAULT_WATCH_MAX_SIZE = 1024**3
+DEFAULT_WATCH_DEBOUNCE = 300.0
+_FD_RELATIVE = os.unlink in os.supports_dir_fd and os.scandir in os.supports_fd
+
+# <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0)
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+INOTIFY_BUFFER = 64 * 1024
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+_TRIE_END = "\0"
+RULE_KEYS = (
+    "junk_suffixes",
+    "junk_dirs",
+    "junk_globs",
+    "junk_paths",
+    "skip",
+    "db_suffixes",
+    "transcripts",
+)
+DESKTOP_KEYS = ("cache_dirs", "dbs")
+# Built-in per-tool rules, on top of [defaults].
+TOOL_RULES = {".claude": {"transcripts": ["projects/*"]}}
+
+
+def _build_trie(paths: Iterable[str]) -> dict[str, dict]:
+    trie: dict[str, dict] = {}
+    for path in paths:
+        node = trie
+        for part in path.strip("/").split("/"):
+            node = node.setdefault(part, {})
+        node[_TRIE_END] = {}
+    return trie
+
+
+def _trie_match(trie: dict[str, dict], rel: str) -> bool:
+    """Whether rel or one of its ancestors is in trie; "*" matches one component."""
+    nodes = [trie]
+    for part in rel.split(os.sep):
+        nodes = [n[key] for n in nodes for key in (part, "*") if key in n]
+        if not nodes:
+            return False
+        if any(_TRIE_END in n for n in nodes):
+            return True
+    return False
+
+
+class ToolRules:
+    """Junk rules for one tool dir, compiled so checks stay cheap as rules grow.
+
+    Suffixes are bucketed by their last extension, so a name is only compared
+    against the few suffixes sharing its extension; globs are one combined regex
+    over the name; path rules and skip rules are component tries over the path
+    relative to the tool dir, matching a path or anything below it.
+    """
+
+    __slots__ = (
+        "_bare",
+        "_db",
+        "_dirs",
+        "_glob",
+        "_paths",
+        "_skip",
+        "_suffixes",
+        "_transcripts",
+    )
+
+    def __init__(self, spec: dict[str, list[str]]) -> None:
+        self._suffixes: dict[str, tuple[str, ...]] = {}
+        self._bare: tuple[str, ...] = ()
+        for suffix in spec["junk_suffixes"]:
+            dot = suffix.rfind(".")
+            if dot < 0:
+                self._bare += (suffix,)
+            else:
+                ext = suffix[dot:]
+                self._suffixes[ext] = (*self._suffixes.get(ext, ()), suffix)
+        self._dirs = frozenset(d.lower() for d in spec["junk_dirs"])
+        self._glob = compile_globs(spec["junk_globs"])
+        self._paths = _build_trie(spec["junk_paths"])
+        self._skip = _build_trie(spec["skip"])
+        self._db = tuple(spec["db_suffixes"])
+        self._transcripts = _build_trie(spec["transcripts"])
+
+    def junk_file(self, name: str) -> bool:
+        dot = name.rfind(".")
+        if dot >= 0 and name.endswith(self._suffixes.get(name[dot:], ())):
+            return True
+        if self._bare and name.endswith(self._bare):
+            return True
+        return self._glob is not None and self._glob.match(name) is not None
+
+    def junk_dir(self, name: str) -> bool:
+        return name.lower() in self._dirs
+
+    def junk_path(self, rel: str) -> bool:
+        return bool(self._paths) and _trie_match(self._paths, rel)
+
+    def skipped(self, rel: str) -> bool:
+        return bool(self._skip) and _trie_match(self._skip, rel)
+
+    def is_db(self, name: str) -> bool:
+        return name.endswith(self._db)
+
+    def transcript(self, rel: str) -> bool:
+        return (
+            rel.endswith(TRANSCRIPT_SUFFIX)
+            and bool(self._transcripts)
+            and _trie_match(self._transcripts, rel)
+        )
+
+    def needs_attention(self, name: str) -> bool:
+        """Files acted on regardless of age; a manifest never vouches for their dir."""
+        return self.junk_file(name) or self.is_db(name)
+
+
+class Rules:
+    """Junk-matching rules for every tool dir plus the Desktop layout.
+
+    Built-in defaults mirror the module constants. A TOML rules file may
+    override any list under [defaults], extend it per tool under
+    [tools."<dir>"] (new dirs there are cleaned too), and replace the Desktop
+    lists under [desktop]:
+
+        [defaults]
+        junk_globs = ["core.*", "*.dmp"]
+
+        [tools.".claude"]
+        junk_paths = ["shell-snapshots", "statsig/*/cache"]
+        skip = ["projects/*/memory"]
+
+        [desktop]
+        cache_dirs = ["Cache/Cache_Data", "GPUCache"]
+
+    Tool keys are junk_suffixes, junk_dirs, junk_globs, junk_paths (relative
+    paths, "*" per component), skip (subtrees never descended into),
+    db_suffixes and transcripts (subtrees whose *.jsonl files are session
+    transcripts, for --compact-transcripts).
+    """
+
+    def __init__(self, data: dict[str, object]) -> None:
+        unknown = set(data) - {"defaults", "tools", "desktop"}
+        if unknown:
+            msg = f"unknown rules section(s): {', '.join(sorted(unknown))}"
+            raise ValueError(msg)
+        base: dict[str, list[str]] = {
+            "junk_suffixes": list(JUNK_SUFFIXES),
+            "junk_dirs": list(JUNK_DIR_NAMES),
+            "junk_globs": [],
+            "junk_paths": [],
+            "skip": [],
+            "db_suffixes": list(DB_SUFFIXES),
+            "transcripts": [],
+        }
+        base.update(self._section(data.get("defaults", {}), "defaults"))
+        self._base = base
+        tools = data.get("tools", {})
+        if not isinstance(tools, dict):
+            msg = "[tools] must be a table"
+            raise ValueError(msg)  # noqa: TRY004 - surfaced as a CLI error
+        for name in tools:
+            # Each name is joined onto a home dir and everything under it cleaned.
+            if (
+                name in {"", "."}
+                or Path(name).is_absolute()
+                or "/" in name
+                or os.sep in name
+                or ".." in name
+            ):
+                msg = f"[tools.{name!r}] must name a dir directly inside home"
+                raise ValueError(msg)
+        self.tools = GENERIC_DIRS + tuple(t for t in tools if t not in GENERIC_DIRS)
+        self._compiled: dict[str, ToolRules] = {}
+        for name in self.tools:
+            extra = self._section(tools.get(name, {}), f"tools.{name}")
+            builtin = TOOL_RULES.get(name, {})
+            spec = {
+                k: base[k] + builtin.get(k, []) + extra.get(k, []) for k in RULE_KEYS
+            }
+            self._compiled[name] = ToolRules(spec)
+        desktop = self._section(data.get("desktop", {}), "desktop", DESKTOP_KEYS)
+        for key, rels in desktop.items():
+            for rel in rels:
+                # Cleared or vacuumed under claude_dir, so it must stay inside it.
+                if (
+                    rel in {"", "."}
+                    or Path(rel).is_absolute()
+                    or rel.startswith(("/", os.sep))
+                    or ".." in Path(rel).parts
+                ):
+                    msg = f"[desktop] {key} entry {rel!r} must be relative, no '..'"
+                    raise ValueError(msg)
+        self.desktop_cache_dirs = tuple(desktop.get("cache_dirs", DESKTOP_CACHE_DIRS))
+        self.desktop_dbs = tuple(desktop.get("dbs", DESKTOP_DBS))
+        canon = json.dumps(data, sort_keys=True, default=str).encode()
+        self.fingerprint = hashlib.blake2b(canon, digest_size=8).hexdigest()
+
+    @staticmethod
+    def _section(
+        raw: object,
+        where: str,
+        keys: tuple[str, ...] = RULE_KEYS,
+    ) -> dict[str, list[str]]:
+        if not isinstance(raw, dict):
+            msg = f"[{where}] must be a table"
+            raise ValueError(msg)  # noqa: TRY004 - surfaced as a CLI error
+        for key, value in raw.items():
+            if key not in keys:
+                msg = f"unknown key {key!r} in [{where}]"
+                raise ValueError(msg)
+            if not isinstance(value, list) or not all(
+                isinstance(v, str) for v in value
+            ):
+                msg = f"[{where}] {key} must be a list of strings"
+                raise ValueError(msg)
+        return raw
+
+    @classmethod
+    @functools.cache
+    def default(cls) -> Rules:
+        return cls({})
+
+    @classmethod
+    def load(cls, path: Path) -> Rules:
+        try:
+            with path.open("rb") as fh:
+                return cls(tomllib.load(fh))
+        except (OSError, tomllib.TOMLDecodeError) as exc:
+            msg = f"cannot read rules {path}: {exc}"
+            raise ValueError(msg) from exc
+
+    def for_tool(self, name: str) -> ToolRules:
+        rules = self._compiled.get(name)
+        if rules is None:
+            # An ad-hoc target (tests, a tree outside the configured tools).
+            rules = self._compiled[name] = ToolRules(self._base)
+        return rules
+
+
+@dataclass(frozen=True, slots=True)
+class Options:
+    days: int = 30
+    dry_run: bool = False
+    verbose: bool = False
+    force: bool = False
+    jobs: int = DEFAULT_JOBS
+    db_jobs: int = DEFAULT_DB_JOBS
+    vacuum_threshold: float = DEFAULT_VACUUM_THRESHOLD
+    optimize: bool = False
+    vacuum_into: bool = False
+    log_lines: int | None = DEFAULT_LOG_LINES
+    log_max_bytes: int | None = None
+    manifest: Path | None = None
+    db_maintenance: bool = True
+    quotas: tuple[tuple[str, int], ...] = ()
+    protect: tuple[str, ...] = DEFAULT_QUOTA_PROTECT
+    archive: Path | None = None
+    archive_format: str = "gz"
+    archive_keep: int = DEFAULT_ARCHIVE_KEEP
+    dedupe: str | None = None
+    rules: Rules = field(default_factory=Rules.default)
+    cache_days: int | None = None
+    cache_budget: int | None = None
+    trash: Path | None = None
+    trash_keep: float = DEFAULT_TRASH_KEEP
+    io_rate: int | None = None
+    ops_rate: int | None = None
+    # Wall-clock time.time() by which a --max-seconds run must stop starting work.
+    deadline: float | None = None
+    compact_days: int | None = None
+    gzip_days: int | None = None
+    payload_limit: int = DEFAULT_PAYLOAD_LIMIT
+    journal: Path | None = None
+    journal_max_age: float = DEFAULT_JOURNAL_MAX_AGE
 
 
 def log(msg: str) -> None:
-    print(f"[cleanup] {msg}")
+    out = sys.stderr if REPORT.structured or REPORT.log_to_stderr else sys.stdout
+    print(f"[cleanup{REPORT.label}] {msg}", file=out)
 
 
 def warn(msg: str) -> None:
-    print(f"[warn] {msg}", file=sys.stderr)
+    print(f"[warn{REPORT.label}] {msg}", file=sys.stderr)
+
+
+class Reporter:
+    """Stream one record per planned or executed action, then a summary.
+
+    ndjson writes one object per line; json writes the same objects as a single
+    array, still flushed record by record so nothing is buffered. In those modes
+    log() moves to stderr to keep stdout parseable. Text mode emits no records
+    but still keeps phase timings and per-outcome totals.
+    """
+
+    FORMATS = ("text", "ndjson", "json")
+
+    def __init__(self) -> None:
+        self.fmt = "text"
+        self.out: TextIO = sys.stdout
+        self.phases: dict[str, float] = {}
+        self.totals: dict[str, list[int]] = {}
+        self.trees: list[dict[str, object]] = []
+        # Fleet workers tag their log lines with the home they are cleaning.
+        self.label = ""
+        self.log_to_stderr = False
+        self.profile = False
+        self.counters: dict[str, int] = {}
+        self.db_seconds: dict[str, float] = {}
+        self.throttle: dict[str, float] = {}
+        self.events: list[dict[str, object]] | None = None
+        self._epoch = time.perf_counter()
+        self._lock = threading.Lock()
+        self._written = 0
+
+    @property
+    def structured(self) -> bool:
+        return self.fmt != "text"
+
+    def configure(self, fmt: str, out: TextIO | None = None) -> None:
+        self.fmt = fmt
+        self.out = out or sys.stdout
+        if fmt == "json":
+            self.out.write("[\n")
+
+    def enable_profile(self, *, trace: bool = False) -> None:
+        self.profile = True
+        if trace:
+            self.events = []
+
+    @contextmanager
+    def phase(self, name: str, **args: object) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+                if self.events is not None:
+                    self._event(name, "phase", start, elapsed, args)
+
+    @contextmanager
+    def span(self, name: str, **args: object) -> Iterator[None]:
+        """Like phase() but only traced, for outer spans that would double-count."""
+        if self.events is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._event(name, "run", start, elapsed, args)
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Bump a profiling counter; callers pass batched totals, not per-entry 1s."""
+        if self.profile:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_throttle(self, stats: dict[str, float]) -> None:
+        """Fold in a Throttle's totals.
+
+        Fleet workers run side by side, so wall times overlap (keep the longest)
+        while bytes, ops and limits add up.
+        """
+        with self._lock:
+            for name, value in stats.items():
+                prev = self.throttle.get(name, 0)
+                self.throttle[name] = (
+                    max(prev, value) if name == "seconds" else prev + value
+                )
+
+    def throttle_summary(self) -> dict[str, float]:
+        """Achieved bytes/sec and ops/sec next to their limits."""
+        stats = self.throttle
+        seconds = stats.get("seconds") or 0.0
+        summary: dict[str, float] = {"seconds": round(seconds, 3)}
+        for name in ("bytes", "ops"):
+            if f"{name}_limit" in stats:
+                done = stats[name]
+                summary[name] = done
+                summary[f"{name}_per_sec"] = round(done / seconds) if seconds else 0
+                summary[f"{name}_limit"] = stats[f"{name}_limit"]
+                summary[f"{name}_slept"] = round(stats[f"{name}_slept"], 3)
+        return summary
+
+    def db_time(self, db: Path, start: float, elapsed: float) -> None:
+        if self.profile:
+            with self._lock:
+                self.db_seconds[str(db)] = elapsed
+                if self.events is not None:
+                    self._event(db.name, "db", start, elapsed, {"path": str(db)})
+
+    def write_trace(self, path: Path) -> None:
+        """Dump phase and per-DB spans as Chrome trace-event JSON (chrome://tracing)."""
+        with self._lock:
+            events = list(self.events or ())
+        path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+    def record(
+        self,
+        kind: str,
+        path: Path | str,
+        nbytes: int = 0,
+        *,
+        outcome: str,
+        mtime: float | None = None,
+    ) -> None:
+        with self._lock:
+            total = self.totals.setdefault(outcome, [0, 0])
+            total[0] += 1
+            total[1] += nbytes
+            if self.structured:
+                age = None if mtime is None else (time.time() - mtime) / 86400
+                self._write({
+                    "type": "action",
+                    "kind": kind,
+                    "path": str(path),
+                    "bytes": nbytes,
+                    "age_days": None if age is None else round(age, 2),
+                    "outcome": outcome,
+                })
+
+    def tree(self, root: Path, before: int, after: int) -> None:
+        with self._lock:
+            self.trees.append({"root": str(root), "before": before, "after": after})
+
+    def snapshot(self) -> dict[str, object]:
+        """Aggregates only, small enough to ship back from a fleet worker."""
+        with self._lock:
+            return {
+                "phases": dict(self.phases),
+                "totals": {k: list(v) for k, v in self.totals.items()},
+                "trees": list(self.trees),
+                "counters": dict(self.counters),
+                "db_seconds": dict(self.db_seconds),
+                "throttle": dict(self.throttle),
+            }
+
+    def merge(self, snap: dict[str, object]) -> None:
+        with self._lock:
+            for name, seconds in snap["phases"].items():
+                self.phases[name] = self.phases.get(name, 0.0) + seconds
+            for outcome, (n, nbytes) in snap["totals"].items():
+                total = self.totals.setdefault(outcome, [0, 0])
+                total[0] += n
+                total[1] += nbytes
+            self.trees.extend(snap["trees"])
+            for name, n in snap["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.db_seconds.update(snap["db_seconds"])
+        self.add_throttle(snap["throttle"])
+
+    def profile_summary(self) -> dict[str, object]:
+        """Per-phase seconds and throughput, counters, and per-DB VACUUM times.
+
+        A phase's bytes/sec comes from the `freed:<phase>` counter, so only
+        phases that actually release space report a rate.
+        """
+        phases: dict[str, object] = {}
+        for name, seconds in self.phases.items():
+            row: dict[str, object] = {"seconds": round(seconds, 4)}
+            freed = self.counters.get(f"freed:{name}")
+            if freed is not None:
+                row["bytes"] = freed
+                row["bytes_per_sec"] = round(freed / seconds) if seconds else None
+            phases[name] = row
+        counters = {k: v for k, v in self.counters.items() if ":" not in k}
+        dbs = sorted(self.db_seconds.items(), key=lambda kv: kv[1], reverse=True)
+        return {
+            "phases": phases,
+            "counters": counters,
+            "db_seconds": {k: round(v, 4) for k, v in dbs},
+        }
+
+    def finish(self) -> None:
+        if not self.structured:
+            if self.throttle:
+                self._log_throttle()
+            if self.profile:
+                self._log_profile()
+            return
+        with self._lock:
+            summary: dict[str, object] = {
+                "type": "summary",
+                "phases": {k: round(v, 4) for k, v in self.phases.items()},
+                "totals": {
+                    k: {"count": n, "bytes": b} for k, (n, b) in self.totals.items()
+                },
+                "trees": self.trees,
+            }
+            if self.throttle:
+                summary["throttle"] = self.throttle_summary()
+            if self.profile:
+                summary["profile"] = self.profile_summary()
+            self._write(summary)
+            if self.fmt == "json":
+                self.out.write("]\n")
+            self.out.flush()
+
+    def _log_throttle(self) -> None:
+        t = self.throttle_summary()
+        parts = []
+        if "bytes_limit" in t:
+            parts.append(
+                f"{human(t['bytes_per_sec'])}/s of {human(t['bytes_limit'])}/s "
+                f"(slept {t['bytes_slept']:.1f}s)",
+            )
+        if "ops_limit" in t:
+            parts.append(
+                f"{t['ops_per_sec']:g} ops/s of {t['ops_limit']:g} "
+                f"(slept {t['ops_slept']:.1f}s)",
+            )
+        log(f"throttle: {', '.join(parts)} over {t['seconds']:.1f}s")
+
+    def _log_profile(self) -> None:
+        prof = self.profile_summary()
+        for name, row in prof["phases"].items():
+            line = f"profile: {name:<8} {row['seconds']:8.3f}s"
+            if row.get("bytes_per_sec") is not None:
+                line += f"  {human(row['bytes'])} at {human(row['bytes_per_sec'])}/s"
+            log(line)
+        if prof["counters"]:
+            log("profile: " + " ".join(f"{k}={v}" for k, v in prof["counters"].items()))
+        for db, seconds in list(prof["db_seconds"].items())[:5]:
+            log(f"profile: vacuum {seconds:8.3f}s  {db}")
+
+    def _event(
+        self,
+        name: str,
+        cat: str,
+        start: float,
+        elapsed: float,
+        args: dict,
+    ) -> None:
+        assert self.events is not None
+        self.events.append({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round((start - self._epoch) * 1e6),
+            "dur": round(elapsed * 1e6),
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": {k: str(v) for k, v in args.items()},
+        })
+
+    def _write(self, obj: dict[str, object]) -> None:
+        sep = ",\n" if self.fmt == "json" and self._written else ""
+        self.out.write(sep + json.dumps(obj, separators=(",", ":")))
+        if self.fmt == "ndjson":
+            self.out.write("\n")
+        self.out.flush()
+        self._written += 1
+
+
+REPORT = Reporter()
+
+
+class TokenBucket:
+    """Thread-safe token bucket holding at most one second of rate.
+
+    It starts empty, so even a short run never beats its limit. take() reserves
+    tokens past empty and sleeps off the debt, so a single request larger than
+    the bucket (one huge unlink) still pays its full share and concurrent
+    callers queue up in order.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = 0.0
+        self.taken = 0
+        self.slept = 0.0
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n: float) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self.tokens -= n
+            self.taken += n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.slept += wait
+        if wait:
+            time.sleep(wait)
+
+
+def _thread_wchar() -> int | None:
+    """Bytes this thread has passed to write(), from Linux /proc; None elsewhere."""
+    try:
+        with Path("/proc/thread-self/io").open("rb") as fh:
+            for line in fh:
+                if line.startswith(b"wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Throttle:
+    """Process-wide budgets for bytes deleted or written and for metadata ops.
+
+    Inactive until configure() sets a rate, so the hot paths pay one attribute
+    check. Writes that happen inside SQLite are charged from the thread's own
+    /proc I/O counters, which see VACUUM's real output instead of an estimate.
+    """
+
+    def __init__(self) -> None:
+        self.bytes: TokenBucket | None = None
+        self.ops: TokenBucket | None = None
+        self._start = time.monotonic()
+        self._local = threading.local()
+
+    def configure(self, bytes_rate: int | None, ops_rate: int | None) -> None:
+        self.bytes = None if bytes_rate is None else TokenBucket(bytes_rate)
+        self.ops = None if ops_rate is None else TokenBucket(ops_rate)
+        self._start = time.monotonic()
+
+    @property
+    def active(self) -> bool:
+        return self.bytes is not None or self.ops is not None
+
+    def charge(self, nbytes: int = 0, ops: int = 0) -> None:
+        if self.bytes is not None and nbytes:
+            self.bytes.take(nbytes)
+        if self.ops is not None and ops:
+            self.ops.take(ops)
+
+    def charge_writes(self) -> bool:
+        """Charge what this thread wrote since its last call; False without /proc."""
+        wchar = _thread_wchar()
+        if wchar is None:
+            return False
+        last = getattr(self._local, "wchar", wchar)
+        self._local.wchar = wchar
+        self.charge(wchar - last)
+        return True
+
+    def sqlite_progress(self) -> int:
+        self.charge_writes()
+        return 0
+
+    def stats(self) -> dict[str, float]:
+        stats: dict[str, float] = {"seconds": time.monotonic() - self._start}
+        for name, bucket in (("bytes", self.bytes), ("ops", self.ops)):
+            if bucket is not None:
+                stats[name] = bucket.taken
+                stats[f"{name}_limit"] = bucket.rate
+                stats[f"{name}_slept"] = bucket.slept
+        return stats
+
+
+THROTTLE = Throttle()
+
+
+def lower_priority() -> None:
+    """Drop to nice 19 and, on Linux, the idle I/O scheduling class.
+
+    Called before any worker thread starts; threads and child processes inherit
+    both settings. Best effort: failures only warn.
+    """
+    if hasattr(os, "nice"):
+        os.nice(LOW_NICE)
+    nr = IOPRIO_SET_NR.get(os.uname().machine) if sys.platform == "linux" else None
+    if nr is None:
+        return
+    libc = ctypes.CDLL(None, use_errno=True)
+    prio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, prio) != 0:
+        warn(f"cannot lower I/O priority: {os.strerror(ctypes.get_errno())}")
 
 
 def human(n: int) -> str:
@@ -61,30 +891,930 @@ def human(n: int) -> str:
     return f"{size:.1f}T"
 
 
+def parse_size(text: str) -> int:
+    """Parse a byte count like 512, 64K, 10M or 5G (binary units)."""
+    text = text.strip().upper().removesuffix("B")
+    scale = 1
+    for power, unit in enumerate("KMGT", start=1):
+        if text.endswith(unit):
+            text, scale = text[:-1], 1024**power
+            break
+    try:
+        return int(float(text) * scale)
+    except ValueError:
+        msg = f"invalid size: {text!r}"
+        raise argparse.ArgumentTypeError(msg) from None
+
+
+def parse_positive(text: str) -> int:
+    """Parse a count that must be at least 1."""
+    try:
+        n = int(text)
+    except ValueError:
+        n = 0
+    if n < 1:
+        msg = f"expected a positive integer, got {text!r}"
+        raise argparse.ArgumentTypeError(msg)
+    return n
+
+
+class Entry(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+    is_dir: bool
+    ino: int
+    atime: float
+
+    @classmethod
+    def from_stat(cls, path: str, st: os.stat_result) -> Entry:
+        is_dir = stat.S_ISDIR(st.st_mode)
+        size = 0 if is_dir else st.st_size
+        return cls(path, size, st.st_mtime, is_dir, st.st_ino, st.st_atime)
+
+    @property
+    def last_used(self) -> float:
+        # relatime/noatime mounts leave atime behind mtime; trust the later one.
+        return max(self.atime, self.mtime)
+
+
+def walk_tree(
+    root: Path,
+    skip: Callable[[str], bool] | None = None,
+) -> Iterator[Entry]:
+    """Yield every entry under root (not root itself) with one lstat each.
+
+    Directories are yielded before their contents; symlinks are never followed.
+    A directory for which skip(path) is true is neither yielded nor entered.
+    """
+    stack = [str(root)]
+    listed = stats = 0
+    while stack:
+        top = stack.pop()
+        try:
+            it = os.scandir(top)
+        except OSError:
+            continue
+        listed += 1
+        with it:
+            for de in it:
+                stats += 1
+                try:
+                    st = de.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                entry = Entry.from_stat(de.path, st)
+                if entry.is_dir and skip is not None and skip(de.path):
+                    continue
+                yield entry
+                if entry.is_dir:
+                    stack.append(de.path)
+    REPORT.count("scandir", listed)
+    REPORT.count("stat", stats)
+
+
+class DirRecord(NamedTuple):
+    ino: int
+    mtime_ns: int
+    scanned: float
+    file_bytes: int
+    file_count: int
+    oldest: float
+    subdirs: tuple[str, ...]
+    clean: bool
+
+
+class Manifest:
+    """SQLite record of every directory as of its last full listing.
+
+    A directory whose inode and mtime still match, that held nothing the planner
+    acts on and whose oldest file cannot have crossed the age cutoff yet, does
+    not need to be listed again: only its subdirectories are stat'ed. Appends to
+    existing files do not bump a directory mtime, so sizes reported for skipped
+    directories can lag until something in them is added, removed or ages out.
+    """
+
+    def __init__(self, path: Path, rules: str = "") -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, ino INTEGER,"
+            " mtime_ns INTEGER, scanned REAL, file_bytes INTEGER, file_count INTEGER,"
+            " oldest REAL, subdirs TEXT, clean INTEGER)",
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+        )
+        # `clean` flags depend on the rules; records made under others are void.
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'rules'").fetchone()
+        if row is None or row[0] != rules:
+            with self.conn:
+                self.conn.execute("DELETE FROM dirs")
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('rules', ?)",
+                    (rules,),
+                )
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _range(self, root: Path) -> tuple[str, str, str]:
+        # "0" sorts right after "/", so this bounds every path below root.
+        return str(root), f"{root}/", f"{root}0"
+
+    def load(self, root: Path) -> dict[str, DirRecord]:
+        rows = self.conn.execute(
+            "SELECT * FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            self._range(root),
+        )
+        return {
+            row[0]: DirRecord(
+                *row[1:6],
+                math.inf if row[6] is None else row[6],
+                tuple(row[7].split("\0")) if row[7] else (),
+                bool(row[8]),
+            )
+            for row in rows
+        }
+
+    def save(self, root: Path, records: dict[str, DirRecord]) -> None:
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+                self._range(root),
+            )
+            self.conn.executemany(
+                "INSERT INTO dirs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    (
+                        path,
+                        *r[:5],
+                        None if math.isinf(r.oldest) else r.oldest,
+                        "\0".join(r.subdirs),
+                        int(r.clean),
+                    )
+                    for path, r in records.items()
+                ),
+            )
+
+
+class Inventory:
+    """Single-walk snapshot of a tree that every cleanup phase reads from.
+
+    `removed` is bumped by whoever deletes or shrinks something, so the after-size
+    is derived from the snapshot instead of walking the tree a second time. With a
+    manifest, directories it vouches for contribute their recorded file bytes via
+    `extra` instead of per-file entries. Subtrees the rules skip are left out
+    entirely, bytes included.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        manifest: Manifest | None = None,
+        cutoff: float = -math.inf,
+        rules: ToolRules | None = None,
+    ) -> None:
+        self.root = root
+        self.extra: dict[str, int] = {}
+        self.extra_files: dict[str, int] = {}
+        self.reused = 0
+        self.rules = rules
+        if not root.is_dir():
+            self.entries: list[Entry] = []
+        elif manifest is None:
+            self.entries = list(walk_tree(root, self._skip))
+        else:
+            self.entries = self._walk_cached(manifest, cutoff)
+        self.total = sum(e.size for e in self.entries) + sum(self.extra.values())
+        self.removed = 0
+        REPORT.count("entries", len(self.entries))
+        self._subtree: dict[str, int] | None = None
+        self._children: dict[str, int] | None = None
+
+    def _skip(self, path: str) -> bool:
+        if self.rules is None:
+            return False
+        return self.rules.skipped(path[len(str(self.root)) + 1 :])
+
+    def _walk_cached(self, manifest: Manifest, cutoff: float) -> list[Entry]:
+        rules = self.rules or Rules.default().for_tool(self.root.name)
+        cached = manifest.load(self.root)
+        fresh: dict[str, DirRecord] = {}
+        entries: list[Entry] = []
+        now = time.time()
+        root = str(self.root)
+        stack = [(root, os.lstat(root))]
+        listed = stats = 0
+        while stack:
+            top, st = stack.pop()
+            rec = cached.get(top)
+            if (
+                rec is not None
+                and rec.clean
+                and rec.oldest >= cutoff
+                and (rec.ino, rec.mtime_ns) == (st.st_ino, st.st_mtime_ns)
+                # Too close to the last listing to tell a same-tick change apart.
+                and st.st_mtime < rec.scanned - MANIFEST_RACY_SECONDS
+            ):
+                fresh[top] = rec
+                self.reused += 1
+                if rec.file_bytes:
+                    self.extra[top] = rec.file_bytes
+                if rec.file_count:
+                    self.extra_files[top] = rec.file_count
+                for name in rec.subdirs:
+                    path = os.path.join(top, name)
+                    stats += 1
+                    try:
+                        sub = os.lstat(path)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(sub.st_mode) and not self._skip(path):
+                        entries.append(Entry.from_stat(path, sub))
+                        stack.append((path, sub))
+                continue
+            file_bytes = file_count = 0
+            oldest = math.inf
+            subdirs: list[str] = []
+            clean = True
+            try:
+                it = os.scandir(top)
+            except OSError:
+                continue
+            listed += 1
+            with it:
+                for de in it:
+                    stats += 1
+                    try:
+                        sub = de.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(sub.st_mode):
+                        if self._skip(de.path):
+                            continue
+                        entries.append(Entry.from_stat(de.path, sub))
+                        subdirs.append(de.name)
+                        stack.append((de.path, sub))
+                        continue
+                    entries.append(Entry.from_stat(de.path, sub))
+                    file_bytes += sub.st_size
+                    file_count += 1
+                    oldest = min(oldest, sub.st_mtime)
+                    clean = clean and not rules.needs_attention(de.name)
+            fresh[top] = DirRecord(
+                st.st_ino,
+                st.st_mtime_ns,
+                now,
+                file_bytes,
+                file_count,
+                oldest,
+                tuple(subdirs),
+                clean,
+            )
+        manifest.save(self.root, fresh)
+        REPORT.count("scandir", listed)
+        REPORT.count("stat", stats)
+        return entries
+
+    @property
+    def after(self) -> int:
+        return self.total - self.removed
+
+    def files(self) -> Iterator[Entry]:
+        return (e for e in self.entries if not e.is_dir)
+
+    def subtree_size(self, path: Path | str) -> int:
+        if self._subtree is None:
+            # Contents always follow their directory in walk order, so a reverse
+            # pass sees every descendant before the directory it rolls up into.
+            sizes: dict[str, int] = {str(self.root): 0, **self.extra}
+            for e in reversed(self.entries):
+                own = sizes.pop(e.path, 0) if e.is_dir else e.size
+                parent = os.path.dirname(e.path)
+                sizes[parent] = sizes.get(parent, 0) + own
+                if e.is_dir:
+                    sizes[e.path] = own
+            self._subtree = sizes
+        return self._subtree.get(str(path), 0)
+
+    def child_counts(self) -> dict[str, int]:
+        """Direct children per directory (root included), as a fresh dict."""
+        if self._children is None:
+            counts = dict.fromkeys((e.path for e in self.entries if e.is_dir), 0)
+            counts[str(self.root)] = 0
+            for e in self.entries:
+                parent = os.path.dirname(e.path)
+                counts[parent] = counts.get(parent, 0) + 1
+            for path, n in self.extra_files.items():
+                counts[path] = counts.get(path, 0) + n
+            self._children = counts
+        return dict(self._children)
+
+
+class DirPruner:
+    """Removes directories an inventory's removals leave empty.
+
+    Child counts from the inventory stand in for listing directories: each
+    removal reported to removed() decrements its parent, and prune() removes
+    every directory whose count reached zero, which decrements its own parent in
+    turn, so emptiness cascades upward without a walk, a sort, or a record of
+    the removed paths. rmdir itself is the final check, so a file created since
+    the scan (or a dir already gone with a removed tree) just stops the cascade.
+    removed() is safe to call from Deleter workers.
+    """
+
+    def __init__(self, inv: Inventory) -> None:
+        self.root = str(inv.root)
+        self.counts = inv.child_counts()
+        self._lock = threading.Lock()
+
+    def removed(self, path: str) -> None:
+        parent = os.path.dirname(path)
+        with self._lock:
+            if parent in self.counts:
+                self.counts[parent] -= 1
+
+    def prune(self) -> int:
+        """Remove the emptied directories; return the count."""
+        root, counts = self.root, self.counts
+        stack = [d for d, n in counts.items() if n == 0 and d != root]
+        removed = 0
+        while stack:
+            d = stack.pop()
+            try:
+                Path(d).rmdir()
+            except OSError:
+                continue
+            removed += 1
+            parent = os.path.dirname(d)
+            if parent in counts:
+                counts[parent] -= 1
+                if counts[parent] == 0 and parent != root:
+                    stack.append(parent)
+        return removed
+
+
 def dir_size(path: Path) -> int:
     if path.is_file():
         return path.stat().st_size
     if not path.is_dir():
         return 0
-    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+    return sum(e.size for e in walk_tree(path))
 
 
-def resolve_desktop_dir() -> Path:
-    if sys.platform == "win32":
-        import os
+def file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+class Deleter:
+    """Thread-pool remover that unlinks relative to an open parent-directory fd.
+
+    Work is queued with remove_files/remove_tree/clear_dir and runs immediately;
+    wait() blocks until everything queued so far is done, settle() until the
+    backlog is short enough to queue more. Each worker thread
+    keeps its own [bytes, files] counter so the hot path never takes a lock.
+    on_done(path, bytes, ok) fires per queued file or tree as it completes.
+    With a trash, each queued file or tree is renamed into it instead, and is
+    deleted in place only when the trash lives on another filesystem.
+    """
+
+    def __init__(
+        self,
+        jobs: int = DEFAULT_JOBS,
+        on_done: Callable[[str, int, bool], None] | None = None,
+        trash: Trash | None = None,
+    ) -> None:
+        self.jobs = max(1, jobs)
+        self.on_done = on_done
+        self.trash = trash
+        self.failed: list[tuple[str, OSError]] = []
+        self._pool = ThreadPoolExecutor(self.jobs, thread_name_prefix="rm")
+        self._futures: deque[Future[None]] = deque()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters: dict[str, list[int]] = {}
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.wait()
+        self._pool.shutdown()
+
+    @property
+    def bytes(self) -> int:
+        return sum(c[0] for c in self._counters.values())
+
+    @property
+    def files(self) -> int:
+        return sum(c[1] for c in self._counters.values())
+
+    def per_worker(self) -> dict[str, tuple[int, int]]:
+        return {k: (c[0], c[1]) for k, c in sorted(self._counters.items())}
+
+    def remove_files(self, files: Iterable[tuple[str, int]]) -> None:
+        """Queue (path, size) pairs, batched per parent directory."""
+        by_parent: dict[str, list[tuple[str, int]]] = {}
+        for path, size in files:
+            parent, name = os.path.split(path)
+            by_parent.setdefault(parent, []).append((name, size))
+        for parent, names in by_parent.items():
+            for i in range(0, len(names), UNLINK_BATCH):
+                self._submit(self._unlink_batch, parent, names[i : i + UNLINK_BATCH])
+
+    def remove_tree(self, path: Path | str, size: int = 0) -> None:
+        """Queue a tree; size is only what trash mode reports, as it never walks it."""
+        self._submit(self._remove_tree, str(path), size)
+
+    def clear_dir(self, path: Path | str, size: int = 0) -> None:
+        """Queue removal of everything inside path, keeping path itself.
+
+        In trash mode the dir is staged whole and an empty one put back.
+        """
+        if self.trash is None:
+            self._clear_dir(str(path))
+        else:
+            self._submit(self._swap_dir, str(path), size)
+
+    def _clear_dir(self, path: str) -> None:
+        files: list[tuple[str, int]] = []
+        try:
+            with os.scandir(path) as it:
+                for de in it:
+                    if de.is_dir(follow_symlinks=False):
+                        self.remove_tree(de.path)
+                    else:
+                        files.append((de.path, _lsize(de)))
+        except OSError as exc:
+            self._fail(path, exc)
+        self.remove_files(files)
+
+    def wait(self) -> None:
+        while self._futures:
+            futures, self._futures = self._futures, deque()
+            for fut in futures:
+                fut.result()
+
+    def settle(self, backlog: int) -> None:
+        """Block until at most backlog queued jobs are unfinished."""
+        while len(self._futures) > backlog:
+            self._futures.popleft().result()
+
+    def _submit(self, fn: Callable[..., None], *args: object) -> None:
+        self._futures.append(self._pool.submit(fn, *args))
+
+    def _counter(self) -> list[int]:
+        c = getattr(self._local, "c", None)
+        if c is None:
+            c = self._local.c = [0, 0]
+            with self._lock:
+                self._counters[threading.current_thread().name] = c
+        return c
+
+    def _fail(self, path: str, exc: OSError) -> None:
+        with self._lock:
+            self.failed.append((path, exc))
+
+    def _stage(self, path: str, size: int, c: list[int]) -> bool | None:
+        """Rename path into the trash; None if it must be deleted in place."""
+        assert self.trash is not None
+        THROTTLE.charge(ops=1)
+        try:
+            self.trash.stage(path)
+        except OSError as exc:
+            if isinstance(exc, FileNotFoundError) and not os.path.lexists(path):
+                return True
+            if exc.errno == errno.EXDEV:
+                return None
+            self._fail(path, exc)
+            return False
+        c[0] += size
+        c[1] += 1
+        return True
+
+    def _swap_dir(self, path: str, size: int) -> None:
+        c = self._counter()
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except OSError as exc:
+            self._fail(path, exc)
+            return
+        ok = self._stage(path, size, c)
+        if ok is None:
+            self._clear_dir(path)
+            return
+        if ok:
+            try:
+                Path(path).mkdir()
+                Path(path).chmod(mode)
+            except OSError as exc:
+                self._fail(path, exc)
+        if self.on_done:
+            self.on_done(path, size if ok else 0, ok)
+
+    def _unlink_batch(self, parent: str, names: list[tuple[str, int]]) -> None:
+        c = self._counter()
+        if self.trash is not None:
+            for name, size in names:
+                path = os.path.join(parent, name)
+                ok = self._stage(path, size, c)
+                if ok is None:
+                    ok = self._unlink_at(None, path, size, c)
+                if self.on_done:
+                    self.on_done(path, size if ok else 0, ok)
+            return
+        fd = None
+        if _FD_RELATIVE:
+            try:
+                fd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError as exc:
+                self._fail(parent, exc)
+                return
+        try:
+            for name, size in names:
+                target = name if fd is not None else os.path.join(parent, name)
+                ok = self._unlink_at(fd, target, size, c, parent)
+                if self.on_done:
+                    self.on_done(os.path.join(parent, name), size if ok else 0, ok)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _unlink_at(
+        self,
+        fd: int | None,
+        name: str,
+        size: int,
+        c: list[int],
+        parent: str = "",
+    ) -> bool:
+        THROTTLE.charge(size, 1)
+        try:
+            os.unlink(name, dir_fd=fd)
+        except FileNotFoundError:
+            return True
+        except OSError as exc:
+            self._fail(os.path.join(parent, name), exc)
+            return False
+        c[0] += size
+        c[1] += 1
+        return True
+
+    def _remove_tree(self, path: str, size: int = 0) -> None:
+        c = self._counter()
+        start = c[0]
+        staged = None if self.trash is None else self._stage(path, size, c)
+        if staged is not None:
+            if self.on_done:
+                self.on_done(path, c[0] - start, staged)
+            return
+        if not _FD_RELATIVE:
+            files = [e.size for e in walk_tree(Path(path)) if not e.is_dir]
+            THROTTLE.charge(sum(files), len(files))
+            shutil.rmtree(path, onexc=lambda _f, p, e: self._fail(p, e))
+            if not os.path.lexists(path):
+                c[0] += sum(files)
+                c[1] += len(files)
+        else:
+            parent, name = os.path.split(path)
+            try:
+                pfd = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+            except OSError as exc:
+                self._fail(parent, exc)
+            else:
+                try:
+                    self._rmtree_at(pfd, name, c, path)
+                finally:
+                    os.close(pfd)
+        if self.on_done:
+            self.on_done(path, c[0] - start, not os.path.lexists(path))
 
+    def _rmtree_at(self, parent_fd: int, name: str, c: list[int], path: str) -> None:
+        # Iterative so deep trees don't hit the recursion limit; each frame holds
+        # its listing so a directory is scanned once no matter how often we return.
+        stack: list[tuple[int, str, int, str, Iterator[tuple[str, bool, int]]]] = []
+
+        def push(pfd: int, dname: str, dpath: str) -> None:
+            flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+            try:
+                fd = os.open(dname, flags, dir_fd=pfd)
+            except OSError as exc:
+                self._fail(dpath, exc)
+                return
+            try:
+                with os.scandir(fd) as it:
+                    listing = [
+                        (de.name, de.is_dir(follow_symlinks=False), _lsize(de))
+                        for de in it
+                    ]
+            except OSError as exc:
+                os.close(fd)
+                self._fail(dpath, exc)
+                return
+            stack.append((pfd, dname, fd, dpath, iter(listing)))
+
+        push(parent_fd, name, path)
+        while stack:
+            pfd, dname, fd, dpath, it = stack[-1]
+            for child, is_dir, size in it:
+                if is_dir:
+                    push(fd, child, os.path.join(dpath, child))
+                    break
+                self._unlink_at(fd, child, size, c, dpath)
+            else:
+                stack.pop()
+                os.close(fd)
+                THROTTLE.charge(ops=1)
+                try:
+                    os.rmdir(dname, dir_fd=pfd)
+                except OSError as exc:
+                    self._fail(dpath, exc)
+
+
+def _lsize(de: os.DirEntry[str]) -> int:
+    try:
+        return de.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+
+class Trash:
+    """Staging dir that doomed paths are renamed into and purged from later.
+
+    A run stages into one batch dir named after its start time. The batch index
+    records each original path before its rename, so --undo can put everything
+    back until a later run purges the batch.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.batch = root / f"{time.time_ns()}-{os.getpid()}"
+        self.staged = 0
+        self._lock = threading.Lock()
+        self._index: TextIO | None = None
+
+    def stage(self, path: str) -> None:
+        with self._lock:
+            if self._index is None:
+                self.root.mkdir(mode=0o700, parents=True, exist_ok=True)
+                self.batch.mkdir(mode=0o700)
+                index = self.batch / TRASH_INDEX
+                self._index = index.open("a", encoding="utf-8", buffering=1)
+            name = str(self.staged)
+            self.staged += 1
+            self._index.write(json.dumps([name, path]) + "\n")
+        Path(path).rename(self.batch / name)
+
+
+@functools.cache
+def open_trash(root: Path) -> Trash:
+    """This process's trash batch under root, shared by every Deleter."""
+    return Trash(root)
+
+
+def _trash_batches(root: Path) -> list[tuple[int, Path]]:
+    """(stamp in ns, dir) of each batch under root, oldest first."""
+    batches = []
+    try:
+        with os.scandir(root) as it:
+            for de in it:
+                stamp = de.name.partition("-")[0]
+                if stamp.isdigit() and de.is_dir(follow_symlinks=False):
+                    batches.append((int(stamp), Path(de.path)))
+    except FileNotFoundError:
+        pass
+    return sorted(batches)
+
+
+def schedule_purge(root: Path, keep_hours: float) -> None:
+    """Start a background purge if any batch under root is past keep_hours."""
+    cutoff = time.time_ns() - keep_hours * 3600e9
+    expired = [b for stamp, b in _trash_batches(root) if stamp <= cutoff]
+    if not expired:
+        return
+    cmd = [sys.executable, os.path.abspath(__file__), "--purge-trash"]
+    cmd += ["--trash", str(root), "--trash-keep", str(keep_hours)]
+    subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    log(f"purging {len(expired)} expired trash batch(es) in the background")
+
+
+def purge_trash(root: Path, keep_hours: float, jobs: int = DEFAULT_JOBS) -> int:
+    """Delete batches older than keep_hours at low priority; returns failures.
+
+    Each batch is claimed by renaming it to a dot name first, so two purges
+    never work on the same batch; a claim left by a killed purge is retried.
+    """
+    lower_priority()
+    cutoff = time.time_ns() - keep_hours * 3600e9
+    claimed = [p for p in root.glob(".purging-*") if p.is_dir()]
+    for stamp, batch in _trash_batches(root):
+        if stamp > cutoff:
+            continue
+        claim = root / f".purging-{batch.name}"
+        try:
+            batch.rename(claim)
+        except FileNotFoundError:
+            continue
+        claimed.append(claim)
+    with Deleter(jobs) as rm:
+        for claim in claimed:
+            rm.remove_tree(claim)
+    for p, exc in rm.failed:
+        warn(f"failed to purge {p}: {exc}")
+    log(f"purged {len(claimed)} trash batch(es), {human(rm.bytes)}")
+    return len(rm.failed)
+
+
+def undo_trash(root: Path) -> int:
+    """Move the newest batch's paths back where they were; returns failures."""
+    batches = [b for _, b in _trash_batches(root) if (b / TRASH_INDEX).is_file()]
+    if not batches:
+        warn(f"nothing to undo in {root}")
+        return 1
+    batch = batches[-1]
+    lines = (batch / TRASH_INDEX).read_text(encoding="utf-8").splitlines()
+    restored = failed = 0
+    # Newest first, so a file staged after its parent dir comes back after it.
+    for name, original in map(json.loads, reversed(lines)):
+        staged = batch / name
+        if not os.path.lexists(staged):
+            continue
+        try:
+            if staged.is_dir() and Path(original).is_dir():
+                # The empty dir clear_dir put back; fails if anything refilled it.
+                Path(original).rmdir()
+            elif os.path.lexists(original):
+                raise FileExistsError(errno.EEXIST, "path exists", original)
+            Path(original).parent.mkdir(parents=True, exist_ok=True)
+            staged.rename(original)
+        except OSError as exc:
+            warn(f"failed to restore {original}: {exc}")
+            failed += 1
+        else:
+            restored += 1
+    if not failed:
+        shutil.rmtree(batch, ignore_errors=True)
+    log(f"restored {restored} path(s) from trash batch {batch.name}")
+    return failed
+
+
+def desktop_path(claude_dir: Path, rel: str) -> Path | None:
+    """claude_dir / rel, or None (with a warning) if it resolves outside claude_dir.
+
+    The rules already refuse absolute and ".." paths; this catches a symlinked
+    component leading elsewhere.
+    """
+    path = claude_dir / rel
+    root = os.path.realpath(claude_dir)
+    if not os.path.realpath(path).startswith(root + os.sep):
+        warn(f"skipping {rel}: it resolves outside {claude_dir}")
+        return None
+    return path
+
+
+def resolve_desktop_dir(home: Path | None = None) -> Path:
+    """Claude Desktop's config dir under home (default: the current user's)."""
+    if home is None:
+        home = Path.home()
+    if sys.platform == "win32":
         appdata = os.environ.get("APPDATA")
-        return (
-            Path(appdata) / "Claude"
-            if appdata
-            else Path.home() / "AppData/Roaming/Claude"
-        )
+        if appdata and home == Path.home():
+            return Path(appdata) / "Claude"
+        return home / "AppData/Roaming/Claude"
     if sys.platform == "darwin":
-        return Path.home() / "Library/Application Support/Claude"
-    return Path.home() / ".config/Claude"
+        return home / "Library/Application Support/Claude"
+    return home / ".config/Claude"
+
+
+class ProcSnapshot(NamedTuple):
+    desktop_uids: frozenset[int]
+    # Owners of Desktop processes whose open files we are not allowed to see.
+    hidden_uids: frozenset[int]
+    open_files: frozenset[str]
+    # Owners of any process whose open files we are not allowed to see.
+    opaque_uids: frozenset[int]
+
+
+@functools.cache
+def proc_snapshot() -> ProcSnapshot | None:
+    """One pass over /proc: who runs Desktop and every file any process holds open.
+
+    Cached for the run (watch mode clears it before each DB round); None where
+    there is no /proc, so callers fall back to process-level checks.
+    """
+    return scan_proc()
+
+
+def scan_proc() -> ProcSnapshot | None:
+    """An uncached proc_snapshot, for checks that must be current."""
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return None
+    me = str(os.getpid())
+    desktop: set[int] = set()
+    hidden: set[int] = set()
+    opaque: set[int] = set()
+    files: set[str] = set()
+    for pid in pids:
+        if pid == me:
+            continue
+        base = f"/proc/{pid}"
+        is_desktop = False
+        try:
+            uid = os.stat(base).st_uid
+            with Path(f"{base}/comm").open() as fh:
+                is_desktop = fh.read().rstrip("\n") in DESKTOP_PROCESS_NAMES
+            fds = os.listdir(f"{base}/fd")
+        except FileNotFoundError:
+            continue
+        except OSError:
+            if is_desktop:
+                hidden.add(uid)
+            opaque.add(uid)
+            continue
+        if is_desktop:
+            desktop.add(uid)
+        for fd in fds:
+            try:
+                target = os.readlink(f"{base}/fd/{fd}")
+            except OSError:
+                continue
+            if target.startswith("/"):
+                files.add(target)
+    return ProcSnapshot(
+        frozenset(desktop),
+        frozenset(hidden),
+        frozenset(files),
+        frozenset(opaque),
+    )
+
+
+def open_dbs(dbs: Iterable[Path], uid: int | None = None) -> set[Path] | None:
+    """The subset of dbs some process has open, or None if that cannot be known.
+
+    A database counts as open if the file or any of its -wal/-shm/-journal side
+    files is. Unknown means /proc is missing or a Desktop process (of uid, or of
+    anyone) hides its descriptors from us.
+    """
+    snap = proc_snapshot()
+    if snap is None or (snap.hidden_uids if uid is None else uid in snap.hidden_uids):
+        return None
+    busy: set[Path] = set()
+    for db in dbs:
+        real = os.path.realpath(db)
+        if any(real + s in snap.open_files for s in ("", *SQLITE_SIDE_SUFFIXES)):
+            busy.add(db)
+    return busy
+
+
+def db_closed_elsewhere(db: Path) -> bool:
+    """Whether /proc shows no other process holding db or its side files open.
+
+    False whenever that cannot be shown: no /proc, or a process we cannot
+    inspect runs as the db's owner, or as anyone when others may write it.
+    """
+    snap = scan_proc()
+    if snap is None:
+        return False
+    try:
+        st = db.stat()
+    except OSError:
+        return False
+    shared = st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    if st.st_uid in snap.opaque_uids or (shared and snap.opaque_uids):
+        return False
+    real = os.path.realpath(db)
+    return not any(real + s in snap.open_files for s in ("", *SQLITE_SIDE_SUFFIXES))
 
 
-def is_desktop_running() -> bool:
+@functools.cache
+def warn_vacuum_in_place() -> None:
+    """Say once per run that --vacuum-into falls back to VACUUM in place here."""
+    if not Path("/proc").is_dir():
+        warn("no /proc to prove DBs closed; --vacuum-into will VACUUM in place")
+
+
+def is_desktop_running(uid: int | None = None) -> bool:
+    """Whether Claude Desktop is running, optionally only as the given user."""
+    snap = proc_snapshot()
+    if snap is not None:
+        running = snap.desktop_uids | snap.hidden_uids
+        return bool(running) if uid is None else uid in running
+    owner = [] if uid is None else ["-U", str(uid)]
     try:
         if sys.platform == "win32":
             out = subprocess.run(
@@ -95,7 +1825,7 @@ def is_desktop_running() -> bool:
             )
             return "Claude.exe" in out.stdout
         out = subprocess.run(
-            ["pgrep", "-x", "Claude"],
+            ["pgrep", *owner, "-x", "Claude"],
             capture_output=True,
             text=True,
             timeout=5,
@@ -103,7 +1833,7 @@ def is_desktop_running() -> bool:
         if out.returncode == 0:
             return True
         out = subprocess.run(
-            ["pgrep", "-x", "claude"],
+            ["pgrep", *owner, "-x", "claude"],
             capture_output=True,
             text=True,
             timeout=5,
@@ -113,173 +1843,2598 @@ def is_desktop_running() -> bool:
         return False
 
 
-def vacuum_db(db: Path, dry_run: bool, verbose: bool) -> bool:
+class DbBloat(NamedTuple):
+    page_size: int
+    page_count: int
+    freelist_count: int
+    auto_vacuum: int
+
+    @property
+    def free_ratio(self) -> float:
+        return self.freelist_count / self.page_count if self.page_count else 0.0
+
+
+def db_bloat(conn: sqlite3.Connection) -> DbBloat:
+    def pragma(name: str) -> int:
+        return int(conn.execute(f"PRAGMA {name}").fetchone()[0])
+
+    return DbBloat(
+        pragma("page_size"),
+        pragma("page_count"),
+        pragma("freelist_count"),
+        pragma("auto_vacuum"),
+    )
+
+
+def table_fragmentation(conn: sqlite3.Connection) -> list[tuple[str, int, float]]:
+    """Return (table, bytes, unused_ratio) per b-tree, or [] without dbstat."""
+    try:
+        rows = conn.execute(
+            "SELECT name, SUM(pgsize), SUM(unused) FROM dbstat"
+            " GROUP BY name ORDER BY SUM(pgsize) DESC",
+        ).fetchall()
+    except sqlite3.Error:
+        return []
+    return [(name, size, unused / size if size else 0.0) for name, size, unused in rows]
+
+
+def _plan_db_work(bloat: DbBloat, threshold: float, optimize: bool) -> list[str]:
+    steps: list[str] = []
+    if bloat.auto_vacuum == AUTO_VACUUM_INCREMENTAL:
+        if bloat.freelist_count:
+            steps.append("PRAGMA incremental_vacuum")
+    elif bloat.free_ratio >= threshold and (bloat.freelist_count or not threshold):
+        steps.extend(("VACUUM", "PRAGMA optimize" if optimize else "REINDEX"))
+    if optimize and not steps:
+        steps.append("PRAGMA optimize")
+    return steps
+
+
+def vacuum_db(
+    db: Path,
+    dry_run: bool,
+    verbose: bool,
+    *,
+    threshold: float = DEFAULT_VACUUM_THRESHOLD,
+    optimize: bool = False,
+    into: bool = False,
+) -> bool:
+    """Compact db only if its free-page ratio reaches threshold (0 = always).
+
+    Incremental auto_vacuum DBs get incremental_vacuum instead of a rewrite;
+    optimize swaps REINDEX for the much cheaper PRAGMA optimize. With into, the
+    rewrite goes to a side copy that is swapped in atomically (see _vacuum_into)
+    when no other process has the db open, and happens in place otherwise.
+    """
     if not db.is_file():
         return True
     before = db.stat().st_size
-    if dry_run:
-        log(f"[dry-run] would VACUUM+REINDEX {db.name} ({human(before)})")
-        return True
     try:
-        conn = sqlite3.connect(str(db))
-        conn.execute("VACUUM")
-        conn.execute("REINDEX")
-        conn.commit()
-        conn.close()
-    except sqlite3.Error as exc:
+        uri = f"{db.absolute().as_uri()}?mode=ro" if dry_run else str(db)
+        conn = sqlite3.connect(uri, uri=dry_run)
+        try:
+            bloat = db_bloat(conn)
+            steps = _plan_db_work(bloat, threshold, optimize)
+            if verbose:
+                for table, size, unused in table_fragmentation(conn):
+                    log(f"  {db.name}:{table} {human(size)}, {unused:.0%} unused")
+            label = "+".join(s.removeprefix("PRAGMA ") for s in steps) or "skip"
+            summary = f"{human(before)}, {bloat.free_ratio:.0%} free"
+            if dry_run:
+                log(f"[dry-run] would {label} {db.name} ({summary})")
+                return True
+            # Sleeping in the handler stretches the rewrite to the byte budget.
+            tracked = THROTTLE.bytes is not None and THROTTLE.charge_writes()
+            if tracked:
+                conn.set_progress_handler(
+                    THROTTLE.sqlite_progress,
+                    THROTTLE_SQLITE_STEPS,
+                )
+            swapped = into and "VACUUM" in steps and _vacuum_into(conn, db, steps[1:])
+            if steps and not swapped:
+                # executescript steps each statement to completion; a plain
+                # execute() of incremental_vacuum only frees a single page.
+                conn.executescript("".join(f"{step};" for step in steps))
+                # Fold the WAL back into the main file; unlinking it instead
+                # would drop frames a still-attached writer has committed.
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            if tracked:
+                THROTTLE.charge_writes()
+            elif steps:
+                # No per-thread I/O counters: assume the whole file was rewritten.
+                THROTTLE.charge(before)
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as exc:
+        if dry_run:
+            log(f"[dry-run] would inspect {db.name} ({human(before)}): {exc}")
+            return True
         warn(f"failed to VACUUM {db.name}: {exc}")
         return False
     after = db.stat().st_size
     if verbose or before != after:
-        log(f"VACUUM+REINDEX {db.name}: {human(before)} -> {human(after)}")
-    wal = db.with_name(db.name + "-wal")
-    if wal.is_file():
-        wal.unlink()
+        log(f"{label} {db.name} ({summary}): {human(before)} -> {human(after)}")
     return True
 
 
-def truncate_log(path: Path, keep_lines: int, dry_run: bool, verbose: bool) -> None:
-    lines = path.read_text(errors="ignore").splitlines(keepends=True)
-    if len(lines) <= keep_lines:
-        return
-    if dry_run:
+def _vacuum_into(conn: sqlite3.Connection, db: Path, post: list[str]) -> bool:
+    """Compact db into a side file, verify it, then rename it over the original.
+
+    The write lock is only held for the checkpoint-and-rename at the end. A
+    connection still open elsewhere would keep writing to the old inode and
+    its WAL frames would land on the new file, so the swap only happens while
+    /proc shows nobody else holding the db; otherwise nothing is swapped and
+    False is returned, for the caller to VACUUM in place. If another connection
+    committed during the rewrite the copy is stale and is discarded.
+    """
+    if not db_closed_elsewhere(db):
+        return False
+    tmp = db.with_name(f".{db.name}.vacuum-{os.getpid()}")
+    tmp.unlink(missing_ok=True)
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    try:
+        conn.execute("VACUUM INTO ?", (str(tmp),))
+        new = sqlite3.connect(str(tmp))
+        try:
+            if post:
+                new.executescript("".join(f"{step};" for step in post))
+            status = new.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            new.close()
+        if status != "ok":
+            msg = f"quick_check failed on compacted copy: {status}"
+            raise sqlite3.DatabaseError(msg)
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        st = db.stat()
+        Path(tmp).chmod(stat.S_IMODE(st.st_mode))
+        if hasattr(os, "chown"):
+            os.chown(tmp, st.st_uid, st.st_gid)
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA data_version").fetchone()[0] != version:
+                msg = "modified during VACUUM INTO; left in place"
+                raise sqlite3.OperationalError(msg)
+            if not db_closed_elsewhere(db):
+                return False
+            tmp.replace(db)
+        finally:
+            conn.rollback()
+    finally:
+        tmp.unlink(missing_ok=True)
+    return True
+
+
+class DbResult(NamedTuple):
+    db: Path
+    ok: bool
+    before: int
+    after: int
+    seconds: float
+
+    @property
+    def reclaimed(self) -> int:
+        return max(self.before - self.after, 0)
+
+
+def _db_job(db: Path, opts: Options) -> DbResult:
+    before = file_size(db)
+    start = time.perf_counter()
+    ok = vacuum_db(
+        db,
+        opts.dry_run,
+        opts.verbose,
+        threshold=opts.vacuum_threshold,
+        optimize=opts.optimize,
+        into=opts.vacuum_into,
+    )
+    result = DbResult(db, ok, before, file_size(db), time.perf_counter() - start)
+    REPORT.db_time(db, start, result.seconds)
+    outcome = "planned" if opts.dry_run else "compacted" if ok else "failed"
+    REPORT.record("db", db, result.reclaimed, outcome=outcome)
+    return result
+
+
+def maintain_dbs(dbs: Iterable[Path], opts: Options) -> list[DbResult]:
+    """VACUUM independent databases on a bounded pool, largest first.
+
+    Starting the biggest files first keeps one huge DB from running alone at the
+    end while the other workers sit idle.
+    """
+    jobs = sorted((db for db in dbs if db.is_file()), key=file_size, reverse=True)
+    if not jobs:
+        return []
+    if opts.vacuum_into and not opts.dry_run:
+        warn_vacuum_in_place()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(1, opts.db_jobs), thread_name_prefix="db") as pool:
+        results = list(pool.map(lambda db: _db_job(db, opts), jobs))
+    if not opts.dry_run:
+        failed = sum(not r.ok for r in results)
+        if opts.verbose:
+            for r in results:
+                log(f"  {r.db.name}: {human(r.reclaimed)} in {r.seconds:.2f}s")
         log(
-            f"[dry-run] would truncate {path.name} ({len(lines)} -> {keep_lines} lines)",
+            f"DB maintenance: {len(results) - failed} ok, {failed} failed, "
+            f"{human(sum(r.reclaimed for r in results))} reclaimed "
+            f"in {time.perf_counter() - start:.2f}s",
         )
-        return
-    path.write_text("".join(lines[-keep_lines:]))
+    return results
+
+
+def _tail_start_lines(fh: BinaryIO, size: int, keep_lines: int) -> int:
+    """Offset where the last keep_lines lines begin, scanning back block by block."""
+    if size == 0:
+        return 0
+    fh.seek(size - 1)
+    # A trailing newline ends the last line instead of starting an empty one.
+    need = keep_lines + (fh.read(1) == b"\n")
+    if need == 0:
+        return size
+    pos = size
+    while pos > 0:
+        step = min(LOG_BLOCK, pos)
+        pos -= step
+        fh.seek(pos)
+        block = fh.read(step)
+        found = block.count(b"\n")
+        if found >= need:
+            idx = len(block)
+            for _ in range(need):
+                idx = block.rindex(b"\n", 0, idx)
+            return pos + idx + 1
+        need -= found
+    return 0
+
+
+def _tail_start_bytes(fh: BinaryIO, size: int, keep_bytes: int) -> int:
+    """First line start at or after size - keep_bytes."""
+    pos = size - keep_bytes
+    if pos <= 0:
+        return 0
+    pos -= 1
+    fh.seek(pos)
+    while block := fh.read(LOG_BLOCK):
+        idx = block.find(b"\n")
+        if idx >= 0:
+            return pos + idx + 1
+        pos += len(block)
+    return size
+
+
+def _truncate_point(
+    fh: BinaryIO,
+    size: int,
+    keep_lines: int | None,
+    keep_bytes: int | None,
+) -> int:
+    start = 0
+    if keep_lines is not None:
+        start = _tail_start_lines(fh, size, keep_lines)
+    if keep_bytes is not None:
+        start = max(start, _tail_start_bytes(fh, size, keep_bytes))
+    return start
+
+
+def log_excess(
+    path: Path,
+    keep_lines: int | None,
+    keep_bytes: int | None,
+) -> tuple[int, int]:
+    """(size, bytes truncate_log would free) without writing or logging."""
+    try:
+        with path.open("rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            return size, _truncate_point(fh, size, keep_lines, keep_bytes)
+    except OSError:
+        return 0, 0
+
+
+def truncate_log(
+    path: Path,
+    keep_lines: int | None,
+    dry_run: bool,
+    verbose: bool,
+    *,
+    keep_bytes: int | None = None,
+) -> int:
+    """Keep the last keep_lines lines and/or keep_bytes bytes; return bytes freed.
+
+    In dry-run nothing is written and the return value is what would be freed.
+    The tail is found by reading backwards from EOF and then copied down to the
+    start of the file in place, so memory stays at one block whatever the size.
+    """
+    try:
+        fh = path.open("r+b")
+    except OSError as exc:
+        warn(f"failed to open {path.name}: {exc}")
+        return 0
+    with fh:
+        size = os.fstat(fh.fileno()).st_size
+        start = _truncate_point(fh, size, keep_lines, keep_bytes)
+        if start == 0:
+            return 0
+        if dry_run:
+            log(
+                f"[dry-run] would truncate {path.name}"
+                f" ({human(size)} -> {human(size - start)})",
+            )
+            return start
+        read_pos, write_pos = start, 0
+        while True:
+            fh.seek(read_pos)
+            chunk = fh.read(LOG_BLOCK)
+            if not chunk:
+                break
+            THROTTLE.charge(len(chunk))
+            fh.seek(write_pos)
+            fh.write(chunk)
+            read_pos += len(chunk)
+            write_pos += len(chunk)
+        fh.truncate(write_pos)
     if verbose:
-        log(f"truncated {path.name} to last {keep_lines} lines")
+        log(f"truncated {path.name}: {human(size)} -> {human(write_pos)}")
+    return start
 
 
-def plan_generic_removals(target: Path, days: int) -> tuple[list[Path], list[Path]]:
-    """Return (files_to_remove, dirs_to_remove) under target, without touching disk."""
+def age_cutoff(days: int) -> float:
+    return time.time() - days * 86400
+
+
+def iter_generic_removals(
+    target: Path,
+    days: int,
+    inventory: Inventory | None = None,
+    rules: ToolRules | None = None,
+) -> Iterator[Entry]:
+    """Yield what to remove under target, in walk order, without touching disk.
+
+    Files go by junk name, age or junk path; dirs by junk name or path, and
+    carry the size of their whole subtree. Walk order puts a dir before its
+    contents, so nothing inside a yielded dir is yielded: its removal takes
+    everything along.
+    """
     if not target.is_dir():
-        return [], []
-    import time
+        return
+    if rules is None:
+        rules = inventory.rules if inventory else None
+        rules = rules or Rules.default().for_tool(target.name)
+    inv = inventory or Inventory(target, rules=rules)
+    for entry, go in _sort_generic(inv, days, rules):
+        if go:
+            yield entry
+
+
+def _sort_generic(
+    inv: Inventory,
+    days: int,
+    rules: ToolRules,
+) -> Iterator[tuple[Entry, bool]]:
+    """Each file and each junk dir in inv, with whether the generic rules remove it.
 
-    cutoff = time.time() - days * 86400
+    Only the junk dirs seen so far are held, to skip their contents.
+    """
+    cutoff = age_cutoff(days)
+    root = str(inv.root)
+    skip = len(root) + 1
+    doomed: set[str] = set()
+    for entry in inv.entries:
+        if doomed and _under_any(entry.path, doomed, root):
+            continue
+        name = os.path.basename(entry.path)
+        if not entry.is_dir:
+            go = (
+                rules.junk_file(name)
+                or entry.mtime < cutoff
+                or rules.junk_path(entry.path[skip:])
+            )
+            yield entry, go
+        elif rules.junk_dir(name) or rules.junk_path(entry.path[skip:]):
+            doomed.add(entry.path)
+            yield entry._replace(size=inv.subtree_size(entry.path)), True
+
+
+def plan_generic_removals(
+    target: Path,
+    days: int,
+    inventory: Inventory | None = None,
+    rules: ToolRules | None = None,
+) -> tuple[list[Path], list[Path]]:
+    """Return (files_to_remove, dirs_to_remove) under target, without touching disk.
+
+    The whole of iter_generic_removals at once, for callers that want it.
+    """
     files: list[Path] = []
     dirs: list[Path] = []
-    for entry in target.rglob("*"):
-        if entry.is_file():
-            if entry.name.endswith(JUNK_SUFFIXES) or entry.stat().st_mtime < cutoff:
-                files.append(entry)
-        elif entry.is_dir() and entry.name.lower() in JUNK_DIR_NAMES:
-            dirs.append(entry)
+    for entry in iter_generic_removals(target, days, inventory, rules):
+        (dirs if entry.is_dir else files).append(Path(entry.path))
     return files, dirs
 
 
+def parse_quota(text: str) -> tuple[str, int]:
+    """Parse NAME=SIZE (one generic dir) or a bare SIZE (every generic dir)."""
+    name, sep, size = text.rpartition("=")
+    if sep and name not in GENERIC_DIRS:
+        msg = f"unknown dir {name!r}; expected one of {', '.join(GENERIC_DIRS)}"
+        raise argparse.ArgumentTypeError(msg)
+    return (name if sep else "*"), parse_size(size)
+
+
+def compile_globs(patterns: Iterable[str]) -> re.Pattern[str] | None:
+    patterns = list(patterns)
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(p)})" for p in patterns))
+
+
+def plan_quota_evictions(
+    inv: Inventory,
+    quota: int,
+    planned: int = 0,
+    candidates: Iterable[Entry] | None = None,
+    protect: re.Pattern[str] | None = None,
+) -> list[Entry]:
+    """Least-recently-used files whose removal brings inv under quota.
+
+    planned is what other rules already remove, and candidates the files they
+    leave (default: every file in inv). A max-heap keyed on last use
+    holds the oldest files seen so far and is trimmed from the newest end as
+    soon as it covers the excess, so only the k evicted files are ever kept
+    ordered: O(n log k) instead of sorting the tree.
+    """
+    excess = inv.total - planned - quota
+    if excess <= 0:
+        return []
+    root = str(inv.root)
+    heap: list[tuple[float, int, Entry]] = []
+    held = 0
+    for i, e in enumerate(inv.files() if candidates is None else candidates):
+        if held >= excess and -heap[0][0] <= e.last_used:
+            continue
+        if protect and (
+            protect.match(os.path.basename(e.path))
+            or protect.match(os.path.relpath(e.path, root))
+        ):
+            continue
+        heapq.heappush(heap, (-e.last_used, i, e))
+        held += e.size
+        while held - heap[0][2].size >= excess:
+            held -= heapq.heappop(heap)[2].size
+    return [e for _, _, e in sorted(heap, reverse=True)]
+
+
+def _under_any(path: str, roots: set[str], stop: str) -> bool:
+    parent = os.path.dirname(path)
+    while parent not in {stop, path}:
+        if parent in roots:
+            return True
+        path, parent = parent, os.path.dirname(parent)
+    return False
+
+
+def _with_quota(
+    plan: Iterable[Entry],
+    inv: Inventory,
+    rules: ToolRules,
+    quota: int,
+    opts: Options,
+    evicted: set[str],
+) -> Iterator[Entry]:
+    """Pass plan through, then yield the LRU files still over quota after it.
+
+    The evicted paths are also added to evicted, for callers that must skip them.
+    """
+    planned = 0
+    for e in plan:
+        planned += e.size
+        yield e
+    evict = plan_quota_evictions(
+        inv,
+        quota,
+        planned,
+        (e for e, go in _sort_generic(inv, opts.days, rules) if not go),
+        protect=compile_globs(opts.protect),
+    )
+    evicted.update(e.path for e in evict)
+    if evict:
+        freed = human(sum(e.size for e in evict))
+        log(f"quota {human(quota)}: evicting {len(evict)} LRU file(s), {freed}")
+    yield from evict
+
+
+def _compress_member(
+    entry: Entry,
+    arcname: str,
+    codec: str,
+) -> tuple[tarfile.TarInfo, BinaryIO] | None:
+    """Compress one file into a spooled temp file, or None if it changed since the scan."""
+    stored = entry.path.endswith(COMPRESSED_SUFFIXES)
+    spool = tempfile.SpooledTemporaryFile(ARCHIVE_SPOOL)
+    try:
+        with Path(entry.path).open("rb") as src:
+            st = os.fstat(src.fileno())
+            if (st.st_size, st.st_mtime) != (entry.size, entry.mtime):
+                spool.close()
+                return None
+            if stored:
+                shutil.copyfileobj(src, spool, LOG_BLOCK)
+            elif codec == "xz":
+                with lzma.LZMAFile(spool, "wb") as z:
+                    shutil.copyfileobj(src, z, LOG_BLOCK)
+            else:
+                with gzip.GzipFile(
+                    fileobj=spool,
+                    mode="wb",
+                    mtime=int(st.st_mtime),
+                ) as z:
+                    shutil.copyfileobj(src, z, LOG_BLOCK)
+            if os.fstat(src.fileno()).st_mtime != st.st_mtime:
+                spool.close()
+                return None
+    except BaseException:
+        spool.close()
+        raise
+    info = tarfile.TarInfo(arcname + ("" if stored else f".{codec}"))
+    info.size = spool.tell()
+    info.mtime = st.st_mtime
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid, info.gid = st.st_uid, st.st_gid
+    spool.seek(0)
+    return info, spool
+
+
+def archive_files(
+    target: Path,
+    entries: list[Entry],
+    dest: Path,
+    opts: Options,
+) -> tuple[list[tuple[str, int]], int]:
+    """Write entries into a new tar under dest, each member compressed on its own.
+
+    Workers compress into spooled temp files while this thread appends them in
+    order. Members are fsynced in batches and only fsynced ones are returned as
+    (path, size) pairs safe to delete, so a crash or full disk mid-archive never
+    loses an original. Returns those pairs and the archive size.
+    """
+    dest.mkdir(parents=True, exist_ok=True)
+    prefix = target.name.lstrip(".") or "root"
+    archive = dest / f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.tar"
+    safe: list[tuple[str, int]] = []
+    pending: list[tuple[str, int]] = []
+    unsynced = 0
+    window = max(1, opts.jobs) * 2
+    with (
+        archive.open("xb") as fh,
+        ThreadPoolExecutor(max(1, opts.jobs), thread_name_prefix="zip") as pool,
+    ):
+        # Make the archive's directory entry durable before any original goes.
+        dfd = os.open(dest, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+        def sync() -> None:
+            nonlocal unsynced
+            fh.flush()
+            os.fsync(fh.fileno())
+            safe.extend(pending)
+            pending.clear()
+            unsynced = 0
+
+        inflight: deque[tuple[Entry, Future[object]]] = deque()
+        todo = iter(entries)
+        try:
+            with tarfile.open(fileobj=fh, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                while True:
+                    while len(inflight) < window and (e := next(todo, None)):
+                        arcname = os.path.relpath(e.path, target)
+                        fut = pool.submit(
+                            _compress_member,
+                            e,
+                            arcname,
+                            opts.archive_format,
+                        )
+                        inflight.append((e, fut))
+                    if not inflight:
+                        break
+                    e, fut = inflight.popleft()
+                    try:
+                        member = fut.result()
+                    except OSError as exc:
+                        warn(f"failed to archive {e.path}: {exc}")
+                        continue
+                    if member is None:
+                        log(f"skipped {e.path}: changed while archiving")
+                        continue
+                    info, spool = member
+                    THROTTLE.charge(info.size, 1)
+                    with spool:
+                        tar.addfile(info, spool)
+                    pending.append((e.path, e.size))
+                    unsynced += info.size
+                    if unsynced >= ARCHIVE_SYNC_BYTES:
+                        sync()
+            sync()
+        except OSError as exc:
+            warn(f"archive {archive} incomplete: {exc}")
+            for _, fut in inflight:
+                fut.cancel()
+    size = file_size(archive)
+    if not safe:
+        archive.unlink(missing_ok=True)
+        return [], 0
+    old = sorted(dest.glob(f"{prefix}-*.tar"))
+    for stale in old[: max(len(old) - opts.archive_keep, 0)]:
+        stale.unlink(missing_ok=True)
+    return safe, size
+
+
+def _partial_hash(entry: Entry) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    with Path(entry.path).open("rb") as fh:
+        h.update(fh.read(DEDUPE_BLOCK))
+        if entry.size > DEDUPE_BLOCK:
+            fh.seek(max(entry.size - DEDUPE_BLOCK, DEDUPE_BLOCK))
+            h.update(fh.read(DEDUPE_BLOCK))
+    return h.digest()
+
+
+def _full_hash(entry: Entry) -> bytes:
+    with Path(entry.path).open("rb") as fh:
+        return hashlib.file_digest(fh, "blake2b").digest()
+
+
+def _regroup(
+    groups: list[list[Entry]],
+    key: Callable[[Entry], bytes],
+    pool: ThreadPoolExecutor,
+) -> list[list[Entry]]:
+    """Split each group by key(entry), hashed on the pool; drop singletons."""
+    futures = [pool.submit(key, e) for g in groups for e in g]
+    out: list[list[Entry]] = []
+    start = 0
+    for group in groups:
+        buckets: dict[bytes, list[Entry]] = {}
+        for e, fut in zip(group, futures[start : start + len(group)], strict=True):
+            try:
+                buckets.setdefault(fut.result(), []).append(e)
+            except OSError:
+                continue
+        start += len(group)
+        out.extend(b for b in buckets.values() if len(b) > 1)
+    return out
+
+
+def _same_size(entries: Iterable[Entry], min_size: int) -> list[list[Entry]]:
+    """Groups of distinct inodes that share a size, the only possible duplicates."""
+    by_size: dict[int, dict[int, Entry]] = {}
+    for e in entries:
+        if (
+            e.size >= min_size
+            and not e.path.endswith(DEDUPE_SKIP_SUFFIXES)
+            and not os.path.basename(e.path).startswith(DEDUPE_SKIP_PREFIXES)
+        ):
+            by_size.setdefault(e.size, {}).setdefault(e.ino, e)
+    return [list(g.values()) for g in by_size.values() if len(g) > 1]
+
+
+def find_duplicates(
+    entries: Iterable[Entry],
+    jobs: int,
+    min_size: int = DEDUPE_MIN_SIZE,
+) -> list[list[Entry]]:
+    """Group byte-identical files: by size, then first/last block, then full hash.
+
+    Each stage only hashes what the previous one could not tell apart, so most
+    files are never read at all. Hardlinks already sharing an inode count once.
+    """
+    groups = _same_size(entries, min_size)
+    if not groups:
+        return []
+    with ThreadPoolExecutor(max(1, jobs), thread_name_prefix="hash") as pool:
+        groups = _regroup(groups, _partial_hash, pool)
+        # Up to two blocks, the partial hash already covered every byte.
+        small = [g for g in groups if g[0].size <= 2 * DEDUPE_BLOCK]
+        large = [g for g in groups if g[0].size > 2 * DEDUPE_BLOCK]
+        return small + _regroup(large, _full_hash, pool)
+
+
+def _reflink(src: str, dst: str) -> None:
+    import fcntl  # noqa: PLC0415 - POSIX only, and only needed for reflinks
+
+    with Path(src).open("rb") as s, Path(dst).open("xb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _can_reflink(path: str) -> bool:
+    """Whether path's filesystem takes reflinks, tried on a clone removed at once."""
+    head, tail = os.path.split(path)
+    tmp = os.path.join(head, f".{tail}.probe-{os.getpid()}")
+    try:
+        _reflink(path, tmp)
+    except OSError, ImportError:
+        return False
+    finally:
+        Path(tmp).unlink(missing_ok=True)
+    return True
+
+
+def _planned_share(
+    keep: Entry,
+    dup: Entry,
+    mode: str,
+    reflinks: bool,
+    *,
+    link: bool = True,
+) -> str | None:
+    """The kind _share would make of dup given reflink support, for a dry run."""
+    if mode != "hardlink" and reflinks:
+        return "reflink"
+    if mode == "reflink" or (mode == "auto" and not link):
+        return None
+    ks, st = os.lstat(keep.path), os.lstat(dup.path)
+    if (ks.st_mode, ks.st_uid, ks.st_gid) != (st.st_mode, st.st_uid, st.st_gid):
+        msg = f"{dup.path} differs in mode or owner; not hardlinking"
+        raise OSError(msg)
+    return "hardlink"
+
+
+def _share(keep: Entry, dup: Entry, mode: str, *, link: bool = True) -> str | None:
+    """Atomically replace dup with a reflink or hardlink to keep; return the kind.
+
+    Both files are re-checked against the snapshot first so a file written since
+    it was hashed is never replaced. A reflink keeps dup's own metadata; a
+    hardlink is only made when mode bits and owner already agree. In auto mode
+    a failed reflink falls back to a hardlink only if link allows it; otherwise
+    dup is left alone and None returned.
+    """
+    for e in (keep, dup):
+        st = os.lstat(e.path)
+        if (st.st_ino, st.st_size, st.st_mtime) != (e.ino, e.size, e.mtime):
+            msg = f"{e.path} changed since it was hashed"
+            raise OSError(msg)
+    THROTTLE.charge(ops=2)
+    head, tail = os.path.split(dup.path)
+    tmp = os.path.join(head, f".{tail}.dedupe-{os.getpid()}")
+    st = os.lstat(dup.path)
+    kind = "hardlink"
+    try:
+        if mode != "hardlink":
+            try:
+                _reflink(keep.path, tmp)
+                shutil.copystat(dup.path, tmp)
+                if hasattr(os, "chown"):
+                    os.chown(tmp, st.st_uid, st.st_gid)
+                kind = "reflink"
+            except (OSError, ImportError) as exc:
+                Path(tmp).unlink(missing_ok=True)
+                if mode == "reflink":
+                    msg = f"cannot reflink {dup.path}: {exc}"
+                    raise OSError(msg) from exc
+                if not link:
+                    return None
+        if kind == "hardlink":
+            ks = os.lstat(keep.path)
+            if (ks.st_mode, ks.st_uid, ks.st_gid) != (st.st_mode, st.st_uid, st.st_gid):
+                msg = f"{dup.path} differs in mode or owner; not hardlinking"
+                raise OSError(msg)
+            os.link(keep.path, tmp)
+        Path(tmp).replace(dup.path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    return kind
+
+
+def dedupe_files(
+    root: Path,
+    entries: Iterable[Entry],
+    opts: Options,
+    *,
+    link: bool = False,
+) -> int:
+    """Find duplicate files under root and share their storage; return bytes saved.
+
+    The oldest copy in each group is kept. A hardlink ties later writes to every
+    path, so auto mode only falls back to one where link says the files are
+    replaced rather than edited (extension content); --dedupe hardlink opts in
+    everywhere. In dry-run nothing is touched and the return value is what would
+    be saved.
+    """
+    groups = find_duplicates(entries, opts.jobs)
+    mode = opts.dedupe or "auto"
+    saved = linked = unshared = 0
+    # Dry-run only: probed on the first group, as root is one filesystem.
+    reflinks = None
+    for group in groups:
+        keep, *dups = sorted(group, key=lambda e: (e.mtime, e.path))
+        for dup in dups:
+            rel = os.path.relpath(dup.path, root)
+            other = os.path.relpath(keep.path, root)
+            if opts.dry_run:
+                if reflinks is None:
+                    reflinks = mode != "hardlink" and _can_reflink(keep.path)
+                try:
+                    kind = _planned_share(keep, dup, mode, reflinks, link=link)
+                except OSError as exc:
+                    warn(f"would fail to dedupe {rel}: {exc}")
+                    continue
+                if kind is None:
+                    unshared += 1
+                    continue
+                if opts.verbose:
+                    log(f"[dry-run] would {kind} {rel} -> {other}")
+                REPORT.record("dedupe", dup.path, dup.size, outcome="planned")
+            else:
+                try:
+                    kind = _share(keep, dup, mode, link=link)
+                except OSError as exc:
+                    warn(f"failed to dedupe {rel}: {exc}")
+                    REPORT.record("dedupe", dup.path, outcome="failed")
+                    continue
+                if kind is None:
+                    unshared += 1
+                    continue
+                if opts.verbose:
+                    log(f"{kind}ed {rel} -> {other}")
+                REPORT.record("dedupe", dup.path, dup.size, outcome=kind)
+            saved += dup.size
+            linked += 1
+    if linked:
+        verb = "would dedupe" if opts.dry_run else "deduped"
+        log(f"{verb} {linked} file(s) in {len(groups)} group(s), saving {human(saved)}")
+    if unshared:
+        verb = "would leave" if opts.dry_run else "left"
+        log(
+            f"{verb} {unshared} duplicate(s) under {root} unshared: no reflinks "
+            "there, and only --dedupe hardlink would link them",
+        )
+    return saved
+
+
+def _queue_dedupe(
+    queue: WorkQueue,
+    root: Path,
+    entries: list[Entry],
+    inv: Inventory,
+    opts: Options,
+    *,
+    link: bool = False,
+) -> None:
+    """Queue dedupe_files over entries as one action, so a budget covers hashing.
+
+    Same-size groups bound both what it can save and what it may have to read.
+    """
+    groups = _same_size(entries, DEDUPE_MIN_SIZE)
+    if not groups:
+        return
+
+    def dedupe() -> None:
+        with REPORT.phase("dedupe", root=root):
+            saved = dedupe_files(root, entries, opts, link=link)
+        if not opts.dry_run:
+            inv.removed += saved
+            REPORT.count("freed:dedupe", saved)
+
+    most = sum(g[0].size * (len(g) - 1) for g in groups)
+    read = sum(g[0].size * len(g) for g in groups)
+    queue.run(Action("dedupe", str(root), most, read, dedupe))
+
+
+def _shrink(value: object, limit: int) -> tuple[object, bool]:
+    """Cut strings longer than limit inside a tool payload; images become a note."""
+    if isinstance(value, str):
+        if len(value) <= limit:
+            return value, False
+        # The note fits inside the limit, so a second pass finds nothing to cut.
+        keep = max(limit - PAYLOAD_NOTE_ROOM, 0)
+        return f"{value[:keep]}\n[cleanup: {len(value) - keep} chars dropped]", True
+    if isinstance(value, list):
+        pairs = [_shrink(v, limit) for v in value]
+        return [v for v, _ in pairs], any(c for _, c in pairs)
+    if isinstance(value, dict):
+        if value.get("type") == "image":
+            return {"type": "text", "text": "[cleanup: image dropped]"}, True
+        pairs = {k: _shrink(v, limit) for k, v in value.items()}
+        return {k: v for k, (v, _) in pairs.items()}, any(c for _, c in pairs.values())
+    return value, False
+
+
+def compact_record(obj: dict, limit: int) -> bool:
+    """Shrink tool results in one transcript record in place; True if changed.
+
+    Only tool_result blocks of the message and the raw toolUseResult copy are
+    touched; prompts and replies are kept whole.
+    """
+    changed = False
+    message = obj.get("message")
+    content = message.get("content") if isinstance(message, dict) else None
+    if isinstance(content, list):
+        for block in content:
+            if (
+                isinstance(block, dict)
+                and block.get("type") == "tool_result"
+                and "content" in block
+            ):
+                block["content"], hit = _shrink(block["content"], limit)
+                changed |= hit
+    if "toolUseResult" in obj:
+        obj["toolUseResult"], hit = _shrink(obj["toolUseResult"], limit)
+        changed |= hit
+    return changed
+
+
+class _ByteCounter:
+    """Write-only sink that only counts, to size a dry-run compaction."""
+
+    def __init__(self) -> None:
+        self.total = 0
+
+    def write(self, data: bytes) -> int:
+        self.total += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+def _compact_lines(src: BinaryIO, out: BinaryIO | gzip.GzipFile, limit: int) -> None:
+    # Short lines cannot hold an oversized payload and are copied unparsed.
+    for line in src:
+        if len(line) > limit:
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                obj = None
+            if isinstance(obj, dict) and compact_record(obj, limit):
+                end = b"\n" if line.endswith(b"\n") else b""
+                line = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+                line = line.encode() + end
+        out.write(line)
+
+
+def _needs_compaction(src: BinaryIO, limit: int) -> bool:
+    """Whether any record in src holds a payload compact_record would cut."""
+    for line in src:
+        if len(line) > limit:
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(obj, dict) and compact_record(obj, limit):
+                return True
+    return False
+
+
+def compact_transcript(path: Path, limit: int, *, gz: bool, dry_run: bool) -> int:
+    """Rewrite one transcript with tool payloads cut to limit; return bytes saved.
+
+    Streams line by line, so memory is bounded by the longest line. The result
+    goes to a temp file that is fsynced, given the original's mode, owner and
+    times, and renamed over it (or to <name>.gz, dropping the original, with
+    gz). Nothing is replaced if it would not shrink or the source changed, and
+    without gz a transcript with no payload over limit is only read, not copied.
+    """
+    st = path.stat()
+    if not gz:
+        with path.open("rb") as src:
+            if not _needs_compaction(src, limit):
+                return 0
+    tmp = path.with_name(f".{path.name}.compact-{os.getpid()}")
+    sink: BinaryIO | _ByteCounter = _ByteCounter() if dry_run else tmp.open("wb")
+    try:
+        with path.open("rb") as src:
+            if gz:
+                with gzip.GzipFile(
+                    path.name,
+                    "wb",
+                    compresslevel=6,
+                    fileobj=sink,
+                    mtime=int(st.st_mtime),
+                ) as out:
+                    _compact_lines(src, out, limit)
+            else:
+                _compact_lines(src, sink, limit)
+        if isinstance(sink, _ByteCounter):
+            return max(st.st_size - sink.total, 0)
+        sink.flush()
+        os.fsync(sink.fileno())
+        size = sink.tell()
+        sink.close()
+        THROTTLE.charge(size, 2)
+        if size >= st.st_size:
+            return 0
+        shutil.copystat(path, tmp)
+        if hasattr(os, "chown"):
+            os.chown(tmp, st.st_uid, st.st_gid)
+        now = path.stat()
+        if (now.st_size, now.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+            msg = f"{path} changed while compacting"
+            raise OSError(msg)
+        if gz:
+            tmp.replace(path.with_name(path.name + ".gz"))
+            path.unlink()
+        else:
+            tmp.replace(path)
+        return st.st_size - size
+    finally:
+        if not isinstance(sink, _ByteCounter):
+            sink.close()
+            tmp.unlink(missing_ok=True)
+
+
+def transcript_candidates(
+    root: Path,
+    entries: Iterable[Entry],
+    rules: ToolRules,
+    opts: Options,
+) -> list[tuple[Entry, bool]]:
+    """(entry, gzip it) for each transcript idle long enough to compact.
+
+    A transcript touched within --compact-transcripts (and --gzip-transcripts)
+    days is left out, so live sessions are never opened.
+    """
+    days = [d for d in (opts.compact_days, opts.gzip_days) if d is not None]
+    cutoffs = [age_cutoff(d) for d in days]
+    if not cutoffs:
+        return []
+    cutoff = max(cutoffs)
+    gz_cutoff = -math.inf if opts.gzip_days is None else age_cutoff(opts.gzip_days)
+    skip = len(str(root)) + 1
+    return [
+        (e, e.mtime < gz_cutoff)
+        for e in entries
+        if e.mtime < cutoff and rules.transcript(e.path[skip:])
+    ]
+
+
+def compact_transcripts(
+    root: Path,
+    candidates: list[tuple[Entry, bool]],
+    opts: Options,
+) -> int:
+    """Compact the candidates on the worker pool; return bytes saved."""
+
+    def one(item: tuple[Entry, bool]) -> int | OSError:
+        e, gz = item
+        try:
+            return compact_transcript(
+                Path(e.path),
+                opts.payload_limit,
+                gz=gz,
+                dry_run=opts.dry_run,
+            )
+        except OSError as exc:
+            return exc
+
+    saved = compacted = gzipped = 0
+    with ThreadPoolExecutor(max(1, opts.jobs), thread_name_prefix="compact") as pool:
+        for (e, gz), result in zip(candidates, pool.map(one, candidates), strict=True):
+            rel = os.path.relpath(e.path, root)
+            if isinstance(result, OSError):
+                warn(f"failed to compact {rel}: {result}")
+                REPORT.record("transcript", e.path, outcome="failed")
+                continue
+            if not result:
+                continue
+            if opts.verbose:
+                verb = "gzip" if gz else "compact"
+                verb = (
+                    f"would {verb}"
+                    if opts.dry_run
+                    else f"{verb}ped"
+                    if gz
+                    else "compacted"
+                )
+                log(f"{verb} {rel} (-{human(result)})")
+            outcome = "planned" if opts.dry_run else "gzipped" if gz else "compacted"
+            REPORT.record("transcript", e.path, result, outcome=outcome, mtime=e.mtime)
+            saved += result
+            compacted += 1
+            gzipped += gz
+    if compacted:
+        verb = "would compact" if opts.dry_run else "compacted"
+        log(
+            f"{verb} {compacted} transcript(s), {gzipped} gzipped, "
+            f"saving {human(saved)}",
+        )
+    return saved
+
+
+def db_excess(db: Path, opts: Options) -> int | None:
+    """Bytes vacuum_db would reclaim from db, or None if it would do nothing."""
+    try:
+        conn = sqlite3.connect(f"{db.absolute().as_uri()}?mode=ro", uri=True)
+        try:
+            bloat = db_bloat(conn)
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    if not _plan_db_work(bloat, opts.vacuum_threshold, opts.optimize):
+        return None
+    return bloat.freelist_count * bloat.page_size
+
+
+class CostModel:
+    """Seconds per unit of work for each action kind, learned across runs.
+
+    Every run blends what it measured into the saved rates with an exponential
+    moving average, so estimates track the machine without one slow run (a
+    cold cache, a busy disk) swinging the next plan.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.rates = dict(DEFAULT_COSTS)
+        try:
+            saved = json.loads(path.read_text())
+            self.rates.update(
+                (k, float(v)) for k, v in saved["rates"].items() if k in self.rates
+            )
+        except OSError, ValueError, KeyError, TypeError, AttributeError:
+            pass
+
+    def estimate(self, kind: str, units: int) -> float:
+        return COST_OVERHEAD + units * self.rates[kind]
+
+    def observe(self, kind: str, units: int, seconds: float) -> None:
+        if units > 0:
+            rate = max(seconds - COST_OVERHEAD, 0.0) / units
+            old = self.rates[kind]
+            self.rates[kind] = old + COST_SMOOTHING * (rate - old)
+
+    def save(self) -> None:
+        tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}")
+        try:
+            self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            tmp.write_text(json.dumps({"rates": self.rates}, indent=2) + "\n")
+            tmp.replace(self.path)
+        except OSError as exc:
+            tmp.unlink(missing_ok=True)
+            warn(f"cannot save cost model {self.path}: {exc}")
+
+
+class Action(NamedTuple):
+    kind: str
+    path: str
+    nbytes: int
+    units: int
+    run: Callable[[], bool | None]
+    # Blocks until work run() only queued (on a Deleter) has finished.
+    settle: Callable[[], None] | None = None
+
+
+class WorkQueue:
+    """Runs cleanup actions now, or under a deadline best bytes-per-second first.
+
+    Without a deadline run() executes each action on the spot and later() calls
+    its function at once, which is the normal cleanup order. With one, actions
+    are collected and drain() executes them by estimated bytes reclaimed per
+    second until the next one no longer fits, deferring the rest; functions
+    passed to later() (summaries that need the final sizes) run after that.
+    """
+
+    def __init__(self, deadline: float | None = None, model: CostModel | None = None):
+        self.deadline = deadline
+        self.model = model
+        self.actions: list[Action] = []
+        self.finishers: list[Callable[[], None]] = []
+
+    @property
+    def budgeted(self) -> bool:
+        return self.deadline is not None
+
+    def run(self, action: Action) -> bool | None:
+        if not self.budgeted:
+            return action.run()
+        self.actions.append(action)
+        return None
+
+    def later(self, fn: Callable[[], None]) -> None:
+        if self.budgeted:
+            self.finishers.append(fn)
+        else:
+            fn()
+
+    def drain(self) -> int:
+        """Execute queued actions within the deadline; returns the failure count.
+
+        An action that does not fit the time left is deferred, but cheaper ones
+        ranked after it still get their turn.
+        """
+        assert self.deadline is not None
+        assert self.model is not None
+        model = self.model
+        ranked = sorted(
+            self.actions,
+            key=lambda a: a.nbytes / model.estimate(a.kind, a.units),
+            reverse=True,
+        )
+        self.actions = []
+        errors = 0
+        done: list[Action] = []
+        deferred: list[Action] = []
+        start = time.perf_counter()
+        for a in ranked:
+            if time.time() + model.estimate(a.kind, a.units) > self.deadline:
+                deferred.append(a)
+                REPORT.record(a.kind, a.path, a.nbytes, outcome="deferred")
+                continue
+            t0 = time.perf_counter()
+            ok = a.run()
+            if a.settle is not None:
+                a.settle()
+            model.observe(a.kind, a.units, time.perf_counter() - t0)
+            errors += ok is False
+            done.append(a)
+        for fn in self.finishers:
+            fn()
+        self.finishers = []
+        model.save()
+        log(
+            f"budget: ran {len(done)} action(s), ~{human(sum(a.nbytes for a in done))} "
+            f"in {time.perf_counter() - start:.1f}s",
+        )
+        if deferred:
+            log(
+                f"budget: deferred {len(deferred)} action(s), "
+                f"~{human(sum(a.nbytes for a in deferred))}",
+            )
+            for a in deferred:
+                log(f"  deferred {a.kind} {a.path} (~{human(a.nbytes)})")
+        return errors
+
+
+def _queue_dbs(
+    queue: WorkQueue,
+    dbs: Iterable[Path],
+    opts: Options,
+    inv: Inventory | None = None,
+) -> None:
+    """Queue one vacuum action per DB that has work, for a budgeted run."""
+    for db in dbs:
+        excess = db_excess(db, opts)
+        if excess is None:
+            continue
+
+        def run(db: Path = db) -> bool:
+            r = _db_job(db, opts)
+            if inv is not None:
+                inv.removed += r.reclaimed
+            REPORT.count("freed:db", r.reclaimed)
+            return r.ok
+
+        queue.run(Action("vacuum", str(db), excess, file_size(db), run))
+
+
+class Journal:
+    """Write-ahead log of one generic dir's planned removals, for resuming.
+
+    A header keys the journal to its root and to what planning depended on.
+    Each batch of the plan (one record per file or junk tree) is appended just
+    before it is handed to the Deleter, and completed paths follow in batches,
+    at least once a second. A crash can lose only the tail, which at worst
+    means retrying removals, and those are idempotent. The file is removed once
+    the dir's removals have all run.
+    """
+
+    def __init__(self, path: Path, key: dict[str, object]) -> None:
+        self.path = path
+        self.key = key
+        self.created = time.time()
+        # What is left of the plan, when resuming; dirs carry subtree sizes.
+        self.pending: list[Entry] = []
+        # Paths an earlier run already finished with, when resuming.
+        self.finished: set[str] = set()
+        self.archived = False
+        self._resumed = False
+        self._broken = False
+        self._done: list[str] = []
+        self._flushed = time.monotonic()
+        self._fh: TextIO | None = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: Path, key: dict[str, object], max_age: float) -> Self | None:
+        """The plan left at path minus what completed, if it is recent and current.
+
+        A journal that is too old or was planned under other rules or options
+        is discarded.
+        """
+        try:
+            fh = path.open(encoding="utf-8")
+        except OSError:
+            return None
+        with fh:
+            try:
+                header = json.loads(fh.readline())
+            except ValueError:
+                header = {}
+            journal = cls(path, key)
+            journal.created = header.get("created", 0)
+            if (
+                header.get("journal") != JOURNAL_VERSION
+                or {k: header.get(k) for k in key} != key
+                or time.time() - journal.created > max_age
+            ):
+                path.unlink(missing_ok=True)
+                return None
+            plan: dict[str, Entry] = {}
+            done: set[str] = set()
+            for line in fh:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # an append torn by the crash
+                match rec:
+                    case ["f", str(p), int(size), float(mtime) | int(mtime)]:
+                        plan[p] = Entry(p, size, mtime, False, 0, mtime)
+                    case ["d", str(p), int(size)]:
+                        plan[p] = Entry(p, size, 0.0, True, 0, 0.0)
+                    case ["done", list(paths)]:
+                        done.update(paths)
+                    case ["archived", list(kept)]:
+                        journal.archived = True
+                        done.update(kept)
+        journal.pending = [e for p, e in plan.items() if p not in done]
+        journal.finished = done
+        journal._resumed = True
+        return journal
+
+    def plan(self, batch: Iterable[Entry]) -> None:
+        """Append a batch of the plan; a resumed journal already holds its own."""
+        if self._resumed:
+            return
+        records = [
+            ["d", e.path, e.size] if e.is_dir else ["f", e.path, e.size, e.mtime]
+            for e in batch
+        ]
+        with self._lock:
+            self._append(records)
+
+    def done(self, path: str) -> None:
+        with self._lock:
+            self._done.append(path)
+            now = time.monotonic()
+            if (
+                len(self._done) >= JOURNAL_BATCH
+                or now - self._flushed >= JOURNAL_FLUSH_SECONDS
+            ):
+                self._append([["done", self._done]])
+                self._done = []
+                self._flushed = now
+
+    def mark_archived(self, kept: Iterable[str]) -> None:
+        """Record that archiving ran; kept paths did not make it and stay put."""
+        with self._lock:
+            self._append([["archived", sorted(kept)]])
+
+    def close(self, *, finished: bool) -> None:
+        with self._lock:
+            if self._done:
+                self._append([["done", self._done]])
+                self._done = []
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+        if finished:
+            self.path.unlink(missing_ok=True)
+
+    def _append(self, records: list[list[object]]) -> None:
+        if self._broken:
+            return
+        try:
+            if self._fh is None and self._resumed:
+                self._fh = self.path.open("a", encoding="utf-8")
+            elif self._fh is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._fh = self.path.open("w", encoding="utf-8")
+                header = {"journal": JOURNAL_VERSION, "created": self.created}
+                self._fh.write(json.dumps(header | self.key) + "\n")
+            self._fh.write("".join(json.dumps(r) + "\n" for r in records))
+            self._fh.flush()
+        except OSError as exc:
+            # Removing without a journal only costs the ability to resume.
+            warn(f"cannot write journal {self.path}: {exc}")
+            self._broken = True
+
+
+def _batched(items: Iterable[Entry], n: int) -> Iterator[list[Entry]]:
+    batch: list[Entry] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _remove_planned(
+    home: Path,
+    target: Path,
+    plan: Iterable[Entry],
+    opts: Options,
+    journal: Journal | None = None,
+    *,
+    journaled: bool = False,
+    on_removed: Callable[[str], None] | None = None,
+) -> Deleter:
+    """Carry out a removal plan: archive (with --archive), then delete.
+
+    Plan entries are files, or junk dirs sized by their whole subtree, none
+    inside a planned dir. Batches are journaled (unless the caller already
+    journaled the plan) and handed to the Deleter as they come, with at most
+    PIPELINE_DEPTH jobs per worker outstanding, so removal starts with the first
+    batch and only the batches in flight are held. --archive needs the whole
+    plan first, to archive before anything goes. on_removed(path) fires, from a
+    Deleter worker, for each path removed. Returns the spent Deleter, for its
+    counters.
+    """
+    archived: set[str] = set()
+    if opts.archive is not None and not (journal and journal.archived):
+        plan = list(plan)
+        if journal is not None and not journaled:
+            journal.plan(plan)
+            journaled = True
+        keep: list[Entry] = []
+        # A junk dir (logs/ among them) goes whole, so its files are archived too.
+        owner: dict[str, str] = {}
+        with REPORT.phase("archive", root=target):
+            for e in plan:
+                inner = walk_tree(Path(e.path)) if e.is_dir else (e,)
+                for f in inner:
+                    if not f.is_dir and not f.path.endswith(ARCHIVE_SKIP_SUFFIXES):
+                        keep.append(f)
+                        if e.is_dir:
+                            owner[f.path] = e.path
+            safe, size = archive_files(target, keep, home / opts.archive, opts)
+        archived = {p for p, _ in safe}
+        # Anything that did not make it into a synced archive stays put, and so
+        # does the dir holding it.
+        kept = {e.path for e in keep} - archived
+        kept |= {owner[p] for p in kept if p in owner}
+        plan = [e for e in plan if e.path not in kept]
+        if journal is not None:
+            journal.mark_archived(kept)
+        if keep:
+            freed = human(sum(n for _, n in safe))
+            log(f"archived {len(safe)} file(s), {freed} into {human(size)}")
+
+    removed_as = "removed" if opts.trash is None else "trashed"
+    inflight: dict[str, Entry] = {}
+
+    def done(path: str, nbytes: int, ok: bool) -> None:
+        e = inflight.pop(path, None)
+        is_dir = e is not None and e.is_dir
+        outcome = "archived" if path in archived else removed_as
+        REPORT.record(
+            "dir" if is_dir else "file",
+            path,
+            nbytes,
+            outcome=outcome if ok else "failed",
+            mtime=None if e is None or is_dir else e.mtime,
+        )
+        if not ok:
+            return
+        if journal is not None:
+            journal.done(path)
+        if on_removed is not None:
+            on_removed(path)
+        if opts.verbose:
+            rel = os.path.relpath(path, target)
+            log(f"removed dir {rel}/" if is_dir else f"removed {rel}")
+
+    trash = None if opts.trash is None else open_trash(opts.trash)
+    backlog = max(1, opts.jobs) * PIPELINE_DEPTH
+    with (
+        REPORT.phase("delete", root=target),
+        Deleter(opts.jobs, done, trash) as rm,
+    ):
+        for batch in _batched(plan, PLAN_BATCH):
+            if journal is not None and not journaled:
+                journal.plan(batch)
+            inflight.update((e.path, e) for e in batch)
+            rm.remove_files((e.path, e.size) for e in batch if not e.is_dir)
+            for e in batch:
+                if e.is_dir:
+                    rm.remove_tree(e.path, e.size)
+            rm.settle(backlog)
+    for p, exc in rm.failed:
+        warn(f"failed to remove {p}: {exc}")
+    REPORT.count("freed:delete", rm.bytes)
+    REPORT.count("unlinked", rm.files)
+    if opts.verbose:
+        log(_deleter_summary(rm))
+    return rm
+
+
+def _prune_parents(root: Path, parents: set[str]) -> int:
+    """Remove the empty dirs among parents and their ancestors; return the count.
+
+    Deepest go first: the walk-free stand-in for DirPruner without an inventory.
+    """
+    top = str(root) + os.sep
+    pending = set(parents)
+    removed = 0
+    while pending:
+        # A whole level goes before its parents are tried.
+        depth = max(d.count(os.sep) for d in pending)
+        level = {d for d in pending if d.count(os.sep) == depth}
+        pending -= level
+        for d in level:
+            if not d.startswith(top):
+                continue
+            try:
+                Path(d).rmdir()
+            except OSError:
+                continue
+            removed += 1
+            pending.add(os.path.dirname(d))
+    return removed
+
+
+def _resume_generic_dir(
+    home: Path,
+    target: Path,
+    journal: Journal,
+    opts: Options,
+    queue: WorkQueue,
+) -> None:
+    """Finish an interrupted run's removals from its journal, without a walk.
+
+    Files modified since they were planned are left alone. Compaction, dedupe
+    and DB upkeep wait for the next full run.
+    """
+    plan: list[Entry] = []
+    changed = 0
+    for e in journal.pending:
+        try:
+            st = os.lstat(e.path)
+        except OSError:
+            continue
+        if e.is_dir:
+            plan.append(e)
+        elif st.st_mtime != e.mtime:
+            changed += 1
+        else:
+            plan.append(Entry.from_stat(e.path, st))
+    trees = sum(e.is_dir for e in plan)
+    minutes = (time.time() - journal.created) / 60
+    log(
+        f"resuming from journal planned {minutes:.0f} min ago: "
+        f"{len(plan) - trees} file(s) and {trees} dir(s) left",
+    )
+    if changed:
+        log(f"keeping {changed} file(s) modified since they were planned")
+
+    # Only the dirs that held removed paths are kept, not the paths.
+    parents = {os.path.dirname(p) for p in journal.finished}
+
+    def delete() -> None:
+        _remove_planned(
+            home,
+            target,
+            plan,
+            opts,
+            journal,
+            on_removed=lambda p: parents.add(os.path.dirname(p)),
+        )
+        pruned = _prune_parents(target, parents)
+        REPORT.count("pruned", pruned)
+        journal.close(finished=True)
+        if opts.verbose and pruned:
+            log(f"pruned {pruned} empty dir(s)")
+
+    size = sum(e.size for e in plan)
+    queue.run(Action("delete", str(target), size, len(plan), delete))
+
+
 def clean_generic_dir(
     home: Path,
     name: str,
-    days: int,
-    dry_run: bool,
-    verbose: bool,
-) -> None:
+    opts: Options,
+    queue: WorkQueue | None = None,
+) -> Inventory | None:
     target = home / name
     if not target.is_dir():
-        return
+        return None
+    dry_run, verbose = opts.dry_run, opts.verbose
     log(f"==> cleaning {name}")
-    files, dirs = plan_generic_removals(target, days)
-    for f in files:
-        if dry_run:
-            log(f"[dry-run] would remove {f.relative_to(target)}")
+    queue = queue or WorkQueue()
+    quotas = dict(opts.quotas)
+    quota = quotas.get(name, quotas.get("*"))
+    journal = None
+    if opts.journal is not None and not dry_run:
+        path = home / opts.journal / f"{name.lstrip('.')}.jsonl"
+        key = {
+            "root": str(target),
+            "rules": opts.rules.fingerprint,
+            "days": opts.days,
+            "quota": quota,
+            "protect": list(opts.protect),
+        }
+        journal = Journal.load(path, key, opts.journal_max_age * 3600)
+        if journal is not None:
+            _resume_generic_dir(home, target, journal, opts, queue)
+            return None
+        journal = Journal(path, key)
+    rules = opts.rules.for_tool(name)
+    with REPORT.phase("scan", root=target):
+        if opts.manifest is None:
+            inv = Inventory(target, rules=rules)
         else:
-            f.unlink(missing_ok=True)
+            manifest = Manifest(home / opts.manifest, opts.rules.fingerprint)
+            try:
+                # Transcripts start needing work before they are old enough to go.
+                days = min(
+                    d
+                    for d in (opts.days, opts.compact_days, opts.gzip_days)
+                    if d is not None
+                )
+                cutoff = age_cutoff(days)
+                if quota is not None:
+                    # A quota ranks every file, so no dir may be vouched for.
+                    cutoff = math.inf
+                inv = Inventory(target, manifest, cutoff, rules)
+            finally:
+                manifest.close()
             if verbose:
-                log(f"removed {f.relative_to(target)}")
-    for d in dirs:
-        if not d.exists():
+                skipped = human(sum(inv.extra.values()))
+                log(f"manifest vouched for {inv.reused} dir(s), {skipped}")
+    # Planning is lazy: each batch is removed (or reported) as soon as it is
+    # planned. Past the walk snapshot only per-dir state (child counts, junk
+    # dirs) and the quota's evictions are held, never the planned paths, except
+    # where --archive or a budget needs the whole plan up front.
+    plan: Iterable[Entry] = iter_generic_removals(target, opts.days, inv, rules)
+    evicted: set[str] = set()
+    if quota is not None:
+        plan = _with_quota(plan, inv, rules, quota, opts, evicted)
+    if dry_run:
+        for e in plan:
+            rel = os.path.relpath(e.path, target)
+            if e.is_dir:
+                verb = "remove" if opts.archive is None else "archive and remove"
+                log(f"[dry-run] would {verb} dir {rel}/")
+                REPORT.record("dir", e.path, e.size, outcome="planned")
+            else:
+                keep = opts.archive is not None
+                keep = keep and not e.path.endswith(ARCHIVE_SKIP_SUFFIXES)
+                log(f"[dry-run] would {'archive' if keep else 'remove'} {rel}")
+                REPORT.record("file", e.path, e.size, outcome="planned", mtime=e.mtime)
+    else:
+        nbytes = units = 0
+        if queue.budgeted:
+            # Sizing the work against the budget takes the whole plan up front.
+            plan = list(plan)
+            top = {e.path for e in plan if e.is_dir}
+            nbytes = sum(e.size for e in plan)
+            units = len(plan) - len(top)
+            if top:
+                units += sum(_under_any(e.path, top, str(target)) for e in inv.entries)
+            if journal is not None:
+                # Journaled now, so a delete the budget defers can still resume.
+                journal.plan(plan)
+
+        def delete() -> None:
+            pruner = DirPruner(inv)
+            rm = _remove_planned(
+                home,
+                target,
+                plan,
+                opts,
+                journal,
+                journaled=queue.budgeted,
+                on_removed=pruner.removed,
+            )
+            inv.removed += rm.bytes
+            with REPORT.phase("prune", root=target):
+                pruned = pruner.prune()
+            REPORT.count("pruned", pruned)
+            if verbose and pruned:
+                log(f"pruned {pruned} empty dir(s)")
+            if journal is not None:
+                journal.close(finished=True)
+
+        queue.run(Action("delete", str(target), nbytes, units, delete))
+    # Whatever the plan covers, whether or not it has gone yet.
+    survivors = [
+        e
+        for e, go in _sort_generic(inv, opts.days, rules)
+        if not go and e.path not in evicted
+    ]
+    candidates = transcript_candidates(target, survivors, rules, opts)
+    if candidates:
+
+        def compact() -> None:
+            with REPORT.phase("compact", root=target):
+                saved = compact_transcripts(target, candidates, opts)
+            if not dry_run:
+                inv.removed += saved
+                REPORT.count("freed:compact", saved)
+
+        size = sum(e.size for e, _ in candidates)
+        guess = round(size * COMPACT_GUESS)
+        queue.run(Action("compact", str(target), guess, size, compact))
+        # Their contents are about to change under any hash taken now.
+        rewritten = {e.path for e, _ in candidates}
+        survivors = [e for e in survivors if e.path not in rewritten]
+    if opts.dedupe is not None:
+        _queue_dedupe(queue, target, survivors, inv, opts)
+    dbs = [Path(e.path) for e in survivors if rules.is_db(e.path)]
+    if opts.db_maintenance and queue.budgeted and not dry_run:
+        _queue_dbs(queue, dbs, opts, inv)
+    elif opts.db_maintenance:
+        with REPORT.phase("db", root=target):
+            reclaimed = sum(r.reclaimed for r in maintain_dbs(dbs, opts))
+        inv.removed += reclaimed
+        REPORT.count("freed:db", reclaimed)
+    queue.later(lambda: REPORT.tree(target, inv.total, inv.after))
+    return inv
+
+
+def read_simple_index(cache_dir: Path) -> dict[str, float]:
+    """Last-used time (epoch seconds) per entry hash from a Simple Cache index.
+
+    Best effort: a missing, truncated or unknown-version index yields {} and the
+    caller falls back to entry file times.
+    """
+    try:
+        data = (cache_dir / SIMPLE_INDEX).read_bytes()
+    except OSError:
+        return {}
+    if len(data) < _SIMPLE_INDEX_HEADER.size:
+        return {}
+    _, _, magic, version, count, _, _ = _SIMPLE_INDEX_HEADER.unpack_from(data)
+    end = _SIMPLE_INDEX_HEADER.size + count * _SIMPLE_INDEX_ENTRY.size
+    if (
+        magic != SIMPLE_INDEX_MAGIC
+        or version not in SIMPLE_INDEX_VERSIONS
+        or len(data) < end
+    ):
+        return {}
+    return {
+        f"{key:016x}": used / 1e6 - _CHROME_EPOCH_OFFSET
+        for key, used, _ in _SIMPLE_INDEX_ENTRY.iter_unpack(
+            data[_SIMPLE_INDEX_HEADER.size : end],
+        )
+    }
+
+
+def plan_cache_evictions(
+    cache_dir: Path,
+    inv: Inventory,
+    cutoff: float,
+    budget: int | None,
+) -> list[tuple[str, int]] | None:
+    """Files of cold Simple Cache entries to delete; None if cache_dir is not one.
+
+    Entries are ranked by last use, from the index when it can be read and from
+    the entry files' atime/mtime otherwise. Everything last used before cutoff
+    goes, then the oldest of the rest until the dir fits in budget. Leftover
+    todelete_* files always go. Anything else (a blockfile cache such as
+    GPUCache) returns None so the caller clears it as before.
+    """
+    root = str(cache_dir)
+    groups: dict[str, list[Entry]] = {}
+    evict: list[tuple[str, int]] = []
+    simple = (cache_dir / "index-dir").is_dir()
+    for e in inv.files():
+        if os.path.dirname(e.path) != root:
             continue
-        if dry_run:
-            log(f"[dry-run] would remove dir {d.relative_to(target)}/")
+        m = SIMPLE_ENTRY_RE.fullmatch(os.path.basename(e.path))
+        if m is None:
+            continue
+        simple = True
+        if m[1] is None:
+            evict.append((e.path, e.size))
         else:
-            shutil.rmtree(d, ignore_errors=True)
-            if verbose:
-                log(f"removed dir {d.relative_to(target)}/")
-    if not dry_run:
-        for d in sorted(target.rglob("*"), reverse=True):
-            if d.is_dir() and not any(d.iterdir()):
-                d.rmdir()
-    for db in target.rglob("*"):
-        if db.is_file() and db.suffix in DB_SUFFIXES:
-            vacuum_db(db, dry_run, verbose)
+            groups.setdefault(m[1], []).append(e)
+    if not simple:
+        return None
+    index = read_simple_index(cache_dir)
+    ranked = sorted(
+        (index.get(key) or max(e.last_used for e in files), key, files)
+        for key, files in groups.items()
+    )
+    size = sum(e.size for _, _, files in ranked for e in files)
+    for used, _, files in ranked:
+        if used >= cutoff and (budget is None or size <= budget):
+            break
+        evict += [(e.path, e.size) for e in files]
+        size -= sum(e.size for e in files)
+    if len(evict) and index:
+        # Chromium rebuilds a missing index from the entry files on next start.
+        evict.append((
+            str(cache_dir / SIMPLE_INDEX),
+            file_size(cache_dir / SIMPLE_INDEX),
+        ))
+    return evict
 
 
-def clean_desktop(claude_dir: Path, dry_run: bool, verbose: bool, force: bool) -> int:
+def _deleter_summary(rm: Deleter) -> str:
+    workers = ", ".join(
+        f"{name}={files}/{human(nbytes)}"
+        for name, (nbytes, files) in rm.per_worker().items()
+    )
+    return f"deleted {rm.files} file(s), {human(rm.bytes)} [{workers}]"
+
+
+def clean_desktop(
+    claude_dir: Path,
+    opts: Options,
+    queue: WorkQueue | None = None,
+) -> int:
+    dry_run, verbose, force = opts.dry_run, opts.verbose, opts.force
+    queue = queue or WorkQueue()
+    budgeted = queue.budgeted and not dry_run
     errors = 0
     if not claude_dir.is_dir():
         warn(f"Claude Desktop config dir not found: {claude_dir}")
         return 1
 
-    running = is_desktop_running()
-    if running:
-        warn("Claude Desktop appears to be running; VACUUM will fail on locked DBs.")
-        if not force:
-            warn("Pass --force to continue anyway (DB operations will be skipped).")
-            return 1
+    # In fleet mode several users share the host; only this dir's owner matters.
+    uid = None if sys.platform == "win32" else claude_dir.stat().st_uid
+    dbs = [
+        db
+        for rel in opts.rules.desktop_dbs
+        if (db := desktop_path(claude_dir, rel)) is not None
+    ]
+    busy: set[Path] = set()
+    if is_desktop_running(uid):
+        known = open_dbs(dbs, uid)
+        if known is None:
+            warn(
+                "Claude Desktop appears to be running; VACUUM will fail on locked DBs.",
+            )
+            if not force:
+                warn("Pass --force to continue anyway.")
+                return 1
+        else:
+            busy = known
+            warn(f"Claude Desktop is running; skipping {len(busy)} open DB(s).")
+            if not force:
+                warn("Only compacting closed DBs; pass --force to clean caches too.")
+                closed = [db for db in dbs if db not in busy]
+                if budgeted:
+                    _queue_dbs(queue, closed, opts)
+                    return 0
+                with REPORT.phase("db", root=claude_dir):
+                    results = maintain_dbs(closed, opts)
+                return sum(not r.ok for r in results)
 
-    before = dir_size(claude_dir)
+    with REPORT.phase("scan", root=claude_dir):
+        inv = Inventory(claude_dir)
+    before = inv.total
     log(f"Claude Desktop dir: {human(before)}")
 
-    for rel in DESKTOP_CACHE_DIRS:
-        d = claude_dir / rel
-        if d.is_dir():
-            sz = dir_size(d)
+    # Cache dirs are cleared child by child; everything else is registered here.
+    kinds: dict[str, str] = {}
+
+    removed = "removed" if opts.trash is None else "trashed"
+
+    def done(path: str, nbytes: int, ok: bool) -> None:
+        outcome = removed if ok else "failed"
+        REPORT.record(kinds.get(path, "cache"), path, nbytes, outcome=outcome)
+
+    trash = None if opts.trash is None else open_trash(opts.trash)
+    rm = Deleter(opts.jobs, done, trash)
+    cleared: list[tuple[str, int]] = []
+
+    def entries_under(d: Path) -> int:
+        if not budgeted:
+            return 0
+        prefix = str(d) + os.sep
+        return sum(1 for e in inv.entries if e.path.startswith(prefix))
+
+    def clear(d: Path, what: str, sz: int, files: list[tuple[str, int]] | None) -> None:
+        if files is None:
+            rm.clear_dir(d, sz)
+        else:
+            rm.remove_files(files)
+        cleared.append((what, sz))
+
+    selective = opts.cache_days is not None or opts.cache_budget is not None
+    cache_cutoff = -math.inf if opts.cache_days is None else age_cutoff(opts.cache_days)
+    for rel in opts.rules.desktop_cache_dirs:
+        d = desktop_path(claude_dir, rel)
+        if d is None or not d.is_dir():
+            continue
+        evict = None
+        if selective:
+            evict = plan_cache_evictions(d, inv, cache_cutoff, opts.cache_budget)
+        if evict is not None:
+            sz = sum(n for _, n in evict)
             if dry_run:
-                log(f"[dry-run] would clear {rel} ({human(sz)})")
-            else:
-                for child in d.iterdir():
-                    shutil.rmtree(
-                        child,
-                        ignore_errors=True,
-                    ) if child.is_dir() else child.unlink(missing_ok=True)
-                log(f"cleared {rel} ({human(sz)})")
+                log(f"[dry-run] would evict {len(evict)} cold file(s) from {rel}")
+                for f, n in evict:
+                    REPORT.record("cache", f, n, outcome="planned")
+            elif evict:
+                what = f"evicted cold entries from {rel}"
+                run = functools.partial(clear, d, what, sz, evict)
+                queue.run(Action("delete", str(d), sz, len(evict), run, rm.wait))
+            continue
+        sz = inv.subtree_size(d)
+        if dry_run:
+            log(f"[dry-run] would clear {rel} ({human(sz)})")
+            REPORT.record("cache", d, sz, outcome="planned")
+        else:
+            run = functools.partial(clear, d, f"cleared {rel}", sz, None)
+            queue.run(Action("clear", str(d), sz, entries_under(d), run, rm.wait))
+
+    def truncate(f: Path) -> None:
+        with REPORT.phase("logs", root=f.parent):
+            freed = truncate_log(
+                f,
+                opts.log_lines,
+                dry_run,
+                verbose,
+                keep_bytes=opts.log_max_bytes,
+            )
+        if freed:
+            outcome = "planned" if dry_run else "truncated"
+            REPORT.record("log", f, freed, outcome=outcome)
+            inv.removed += 0 if dry_run else freed
+            REPORT.count("freed:logs", 0 if dry_run else freed)
 
     logs_dir = claude_dir / "logs"
     if logs_dir.is_dir():
         for f in logs_dir.glob("*.log"):
-            truncate_log(f, 100, dry_run, verbose)
+            if not budgeted:
+                truncate(f)
+                continue
+            size, excess = log_excess(f, opts.log_lines, opts.log_max_bytes)
+            if excess:
+                run = functools.partial(truncate, f)
+                queue.run(Action("truncate", str(f), excess, size - excess, run))
 
     crashpad = claude_dir / "Crashpad/reports"
     if crashpad.is_dir():
         dumps = list(crashpad.glob("*.dmp"))
         if dumps:
+            sizes = [(str(f), file_size(f)) for f in dumps]
             if dry_run:
                 log(f"[dry-run] would remove {len(dumps)} crash dump(s)")
+                for f, sz in sizes:
+                    REPORT.record("dump", f, sz, outcome="planned")
             else:
-                for f in dumps:
-                    f.unlink(missing_ok=True)
-                log(f"removed {len(dumps)} crash dump(s)")
 
-    if not running or force:
-        for rel in DESKTOP_DBS:
-            db = claude_dir / rel
-            if not vacuum_db(db, dry_run, verbose):
-                errors += 1
+                def remove_dumps() -> None:
+                    kinds.update(dict.fromkeys((f for f, _ in sizes), "dump"))
+                    rm.remove_files(sizes)
+                    log(f"removed {len(dumps)} crash dump(s)")
+
+                total = sum(n for _, n in sizes)
+                queue.run(
+                    Action(
+                        "delete",
+                        str(crashpad),
+                        total,
+                        len(sizes),
+                        remove_dumps,
+                        rm.wait,
+                    ),
+                )
+
+    closed = [db for db in dbs if db not in busy]
+    if budgeted:
+        _queue_dbs(queue, closed, opts, inv)
+    else:
+        with REPORT.phase("db", root=claude_dir):
+            results = maintain_dbs(closed, opts)
+        errors += sum(not r.ok for r in results)
+        reclaimed = sum(r.reclaimed for r in results)
+        inv.removed += reclaimed
+        REPORT.count("freed:db", reclaimed)
 
     for stale in list(claude_dir.glob("*-wal")) + list(claude_dir.glob("*-journal")):
+        if stale.with_name(stale.name.rsplit("-", 1)[0]) in busy:
+            continue
         if stale.is_file() and stale.stat().st_size == 0:
             if dry_run:
                 log(f"[dry-run] would remove empty {stale.name}")
             else:
                 stale.unlink(missing_ok=True)
+            REPORT.record("stale", stale, outcome="planned" if dry_run else "removed")
 
     ext = claude_dir / DESKTOP_DISABLED_EXTENSION
     if ext.is_dir():
-        sz = dir_size(ext)
+        sz = inv.subtree_size(ext)
         if dry_run:
             log(f"[dry-run] would remove disabled PDF extension ({human(sz)})")
+            REPORT.record("extension", ext, sz, outcome="planned")
         else:
-            shutil.rmtree(ext, ignore_errors=True)
-            log(f"removed disabled PDF extension ({human(sz)})")
 
-    after = dir_size(claude_dir)
-    log(f"Desktop cleanup done. Before: {human(before)} -> After: {human(after)}")
+            def remove_ext() -> None:
+                kinds[str(ext)] = "extension"
+                rm.remove_tree(ext, sz)
+                log(f"removed disabled PDF extension ({human(sz)})")
+
+            queue.run(
+                Action("delete", str(ext), sz, entries_under(ext), remove_ext, rm.wait),
+            )
+    extensions = claude_dir / DESKTOP_EXTENSIONS
+    if opts.dedupe is not None and extensions.is_dir():
+        # The disabled extension is (or would be) gone; leave it out.
+        skip = str(ext) + os.sep
+        survivors = [
+            e
+            for e in inv.files()
+            if e.path.startswith(str(extensions) + os.sep)
+            and not e.path.startswith(skip)
+        ]
+        # Installed extensions are replaced, never edited, so hardlinks are safe.
+        _queue_dedupe(queue, extensions, survivors, inv, opts, link=True)
+    queue.later(lambda: _finish_desktop(claude_dir, opts, inv, rm, cleared, before))
     return errors
 
 
+def _finish_desktop(
+    claude_dir: Path,
+    opts: Options,
+    inv: Inventory,
+    rm: Deleter,
+    cleared: list[tuple[str, int]],
+    before: int,
+) -> None:
+    """Wait for Desktop removals, then log and record totals."""
+    dry_run, verbose = opts.dry_run, opts.verbose
+    with REPORT.phase("delete", root=claude_dir):
+        rm.close()
+    for what, sz in cleared:
+        log(f"{what} ({human(sz)})")
+    for p, exc in rm.failed:
+        warn(f"failed to remove {p}: {exc}")
+    inv.removed += rm.bytes
+    REPORT.count("freed:delete", rm.bytes)
+    REPORT.count("unlinked", rm.files)
+    if verbose and not dry_run:
+        log(_deleter_summary(rm))
+    log(f"Desktop cleanup done. Before: {human(before)} -> After: {human(inv.after)}")
+    REPORT.tree(claude_dir, before, inv.after)
+
+
+class HomeResult(NamedTuple):
+    home: Path
+    before: int
+    after: int
+    errors: int
+    seconds: float
+    error: str | None = None
+    report: dict[str, object] | None = None
+
+
+def clean_home(
+    home: Path,
+    opts: Options,
+    *,
+    generic: bool = True,
+    desktop: bool = True,
+) -> HomeResult:
+    start = time.perf_counter()
+    mark = len(REPORT.trees)
+    errors = 0
+    trash = home / (opts.trash or DEFAULT_TRASH_DIR)
+    if opts.trash is not None:
+        opts = replace(opts, trash=trash)
+    queue = WorkQueue()
+    if opts.deadline is not None and not opts.dry_run:
+        queue = WorkQueue(opts.deadline, CostModel(home / COST_MODEL))
+    if generic:
+        invs: list[Inventory] = []
+        with REPORT.span("generic", home=home):
+            for name in opts.rules.tools:
+                inv = clean_generic_dir(home, name, opts, queue)
+                if inv is not None:
+                    invs.append(inv)
+
+        def generic_done() -> None:
+            before = sum(inv.total for inv in invs)
+            after = sum(inv.after for inv in invs)
+            log(
+                f"Generic cleanup done. Tracked dirs before: {human(before)} -> after: {human(after)}",
+            )
+
+        queue.later(generic_done)
+    if desktop:
+        with REPORT.span("desktop", home=home):
+            errors += clean_desktop(resolve_desktop_dir(home), opts, queue)
+    if queue.budgeted:
+        with REPORT.span("budget", home=home):
+            errors += queue.drain()
+    if opts.trash is not None and (staged := open_trash(trash).staged):
+        log(
+            f"staged {staged} path(s) in {open_trash(trash).batch}; purged after "
+            f"{opts.trash_keep:g}h unless restored with --undo",
+        )
+    if not opts.dry_run:
+        schedule_purge(trash, opts.trash_keep)
+    trees = REPORT.trees[mark:]
+    return HomeResult(
+        home,
+        sum(t["before"] for t in trees),
+        sum(t["after"] for t in trees),
+        errors,
+        time.perf_counter() - start,
+    )
+
+
+def expand_homes(patterns: Iterable[str]) -> list[Path]:
+    """Expand home dir globs like /home/* into existing dirs, deduplicated."""
+    homes: dict[str, Path] = {}
+    for pattern in patterns:
+        for match in sorted(glob.glob(os.path.expanduser(pattern))):
+            path = Path(match)
+            if path.is_dir():
+                homes.setdefault(os.path.realpath(path), path)
+    return list(homes.values())
+
+
+def _become_owner(home: Path) -> None:
+    """Run as the home's owner so nothing we create or rewrite changes hands.
+
+    Only possible (and only needed) when started as root; each fleet worker
+    serves a single home, so the switch is never undone.
+    """
+    if not hasattr(os, "geteuid") or os.geteuid() != 0:
+        return
+    st = home.stat()
+    if st.st_uid == 0:
+        return
+    os.setgroups([st.st_gid])
+    os.setgid(st.st_gid)
+    os.setuid(st.st_uid)
+
+
+def _fleet_worker(
+    home: Path,
+    opts: Options,
+    generic: bool,
+    desktop: bool,
+    structured: bool,
+    profile: bool,
+) -> HomeResult:
+    global REPORT
+    REPORT = Reporter()
+    REPORT.label = f":{home.name}"
+    REPORT.log_to_stderr = structured
+    if profile:
+        REPORT.enable_profile()
+    THROTTLE.configure(opts.io_rate, opts.ops_rate)
+    start = time.perf_counter()
+    try:
+        _become_owner(home)
+        # Build hosts rarely have Desktop installed; absence is not an error here.
+        desktop = desktop and resolve_desktop_dir(home).is_dir()
+        result = clean_home(home, opts, generic=generic, desktop=desktop)
+    except Exception as exc:  # noqa: BLE001 - one broken home must not sink the fleet
+        warn(f"{home}: {exc}")
+        result = HomeResult(
+            home,
+            0,
+            0,
+            1,
+            time.perf_counter() - start,
+            f"{type(exc).__name__}: {exc}",
+        )
+    if THROTTLE.active:
+        REPORT.add_throttle(THROTTLE.stats())
+    return result._replace(report=REPORT.snapshot())
+
+
+def run_fleet(
+    homes: list[Path],
+    opts: Options,
+    *,
+    generic: bool,
+    desktop: bool,
+    jobs: int,
+) -> int:
+    """Clean many homes on a process pool, then report per home and in total.
+
+    --jobs/--db-jobs stay global limits: they are split across the homes being
+    cleaned at once. Each home gets a fresh process, so a crash or a privilege
+    switch in one cannot leak into another.
+    """
+    workers = max(1, min(jobs, len(homes)))
+    per_home = replace(
+        opts,
+        jobs=max(1, opts.jobs // workers),
+        db_jobs=max(1, opts.db_jobs // workers),
+        io_rate=None if opts.io_rate is None else max(1, opts.io_rate // workers),
+        ops_rate=None if opts.ops_rate is None else max(1, opts.ops_rate // workers),
+    )
+    results: list[HomeResult] = []
+    with ProcessPoolExecutor(workers, max_tasks_per_child=1) as pool:
+        futures = {
+            pool.submit(
+                _fleet_worker,
+                home,
+                per_home,
+                generic,
+                desktop,
+                REPORT.structured,
+                REPORT.profile,
+            ): home
+            for home in homes
+        }
+        for fut in as_completed(futures):
+            home = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as exc:  # noqa: BLE001 - e.g. a worker killed by a signal
+                result = HomeResult(home, 0, 0, 1, 0.0, f"{type(exc).__name__}: {exc}")
+            if result.report is not None:
+                REPORT.merge(result.report)
+            outcome = "failed" if result.error else "cleaned"
+            freed = result.before - result.after
+            REPORT.record("home", home, freed, outcome=outcome)
+            results.append(result)
+
+    for r in sorted(results):
+        if r.error:
+            log(f"{r.home}: FAILED ({r.error})")
+        else:
+            status = f", {r.errors} error(s)" if r.errors else ""
+            log(
+                f"{r.home}: {human(r.before)} -> {human(r.after)} "
+                f"in {r.seconds:.1f}s{status}",
+            )
+    before = sum(r.before for r in results)
+    after = sum(r.after for r in results)
+    failed = sum(1 for r in results if r.error)
+    log(
+        f"Fleet cleanup done: {len(results)} home(s), {failed} failed. "
+        f"Before: {human(before)} -> After: {human(after)}",
+    )
+    return sum(r.errors for r in results)
+
+
+class Inotify:
+    """Just enough of Linux inotify, through ctypes, to follow a few trees."""
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths: dict[int, str] = {}
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def watch(self, path: str) -> bool:
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            warn(f"cannot watch {path}: {os.strerror(ctypes.get_errno())}")
+            return False
+        self.paths[wd] = path
+        return True
+
+    def read(self, timeout: float | None) -> list[tuple[int, str]]:
+        """Block up to timeout for events; return (mask, path) pairs.
+
+        A queue overflow is reported as (IN_Q_OVERFLOW, "") so the caller can
+        resynchronise from disk.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, INOTIFY_BUFFER)
+        except BlockingIOError:
+            return []
+        events: list[tuple[int, str]] = []
+        off = 0
+        while off < len(buf):
+            wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(buf, off)
+            off += _INOTIFY_EVENT.size
+            name = os.fsdecode(buf[off : off + length].rstrip(b"\0"))
+            off += length
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            base = self.paths.get(wd)
+            if mask & IN_Q_OVERFLOW or base is None:
+                events.append((IN_Q_OVERFLOW, ""))
+                continue
+            events.append((mask, os.path.join(base, name) if name else base))
+        return events
+
+
+class WatchedTree:
+    """Running byte total and oldest mtime for one root, kept current by events.
+
+    Subtrees the rules skip are neither watched nor counted, as the cleaner never
+    enters them. After a clean, settle() takes what is left as the baseline.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        name: str,
+        is_cache: bool,
+        rules: ToolRules | None = None,
+    ) -> None:
+        self.root = str(root)
+        self.name = name
+        self.is_cache = is_cache
+        self.rules = rules
+        self.files: dict[str, tuple[int, float]] = {}
+        self.total = 0
+        self.quiet_until = 0.0
+        # Total left by the last clean; only growth past it triggers again.
+        self.floor = 0
+        # (mtime, path) of every file, plus stale pairs that oldest() skips.
+        self._ages: list[tuple[float, str]] = []
+        # Files already past --days that the last clean kept, by mtime.
+        self._kept: dict[str, float] = {}
+
+    def owns(self, path: str) -> bool:
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def resync(self, ino: Inotify) -> None:
+        self.files.clear()
+        self._ages.clear()
+        self.total = 0
+        if Path(self.root).is_dir():
+            ino.watch(self.root)
+            self._add_tree(self.root, ino)
+
+    def _skipped(self, path: str) -> bool:
+        return self.rules is not None and self.rules.skipped(path[len(self.root) + 1 :])
+
+    def _add_tree(self, top: str, ino: Inotify) -> None:
+        for e in walk_tree(Path(top), self._skipped):
+            if e.is_dir:
+                ino.watch(e.path)
+            else:
+                self._set(e.path, e.size, e.mtime)
+
+    def update(self, path: str, ino: Inotify) -> None:
+        if self._skipped(path):
+            return
+        try:
+            st = os.lstat(path)
+        except OSError:
+            self.drop(path)
+            return
+        if stat.S_ISDIR(st.st_mode):
+            # Anything created before the watch landed was missed; list it now.
+            ino.watch(path)
+            self._add_tree(path, ino)
+            return
+        self._set(path, st.st_size, st.st_mtime)
+
+    def _set(self, path: str, size: int, mtime: float) -> None:
+        old, when = self.files.get(path, (0, None))
+        self.files[path] = (size, mtime)
+        self.total += size - old
+        if when != mtime:
+            heapq.heappush(self._ages, (mtime, path))
+            if len(self._ages) > 2 * len(self.files) + 64:
+                self._ages = [(m, p) for p, (_, m) in self.files.items()]
+                heapq.heapify(self._ages)
+
+    def drop(self, path: str) -> None:
+        if path in self.files:
+            self.total -= self.files.pop(path)[0]
+            return
+        prefix = path + os.sep
+        for p in [p for p in self.files if p.startswith(prefix)]:
+            self.total -= self.files.pop(p)[0]
+
+    def oldest(self) -> float:
+        """Oldest mtime still tracked, dropping heap pairs that went stale."""
+        ages = self._ages
+        while ages:
+            mtime, path = ages[0]
+            now = self.files.get(path)
+            if now is not None and now[1] == mtime and self._kept.get(path) != mtime:
+                return mtime
+            heapq.heappop(ages)
+        return math.inf
+
+    def settle(self, days: int) -> None:
+        """Take the tree as the last clean left it as the new baseline.
+
+        Whatever stayed over the size limit, or past --days, is something the
+        rules keep; cleaning again before it grows or another file ages out
+        would only repeat the same walk.
+        """
+        self.floor = self.total
+        cutoff = age_cutoff(days)
+        self._kept = {p: m for p, (_, m) in self.files.items() if m < cutoff}
+
+    def age_deadline(self, days: int) -> float:
+        if self.is_cache:
+            return math.inf
+        return self.oldest() + days * 86400
+
+
+def _db_for(path: str, trees: list[WatchedTree], desktop_dbs: set[str]) -> str | None:
+    base = path.removesuffix("-wal").removesuffix("-journal")
+    if base in desktop_dbs:
+        return base
+    if base.endswith(DB_SUFFIXES) and any(
+        not t.is_cache and t.owns(base) for t in trees
+    ):
+        return base
+    return None
+
+
+def _clear_watched_cache(t: WatchedTree, opts: Options, trash: Path) -> None:
+    """Shrink a Desktop cache dir that crossed the watch limit.
+
+    With --cache-days or --cache-budget only cold Simple Cache entries go, as
+    in a one-shot run; otherwise (or for a blockfile cache) the dir is cleared.
+    """
+    evict = None
+    if opts.cache_days is not None or opts.cache_budget is not None:
+        d = Path(t.root)
+        cutoff = -math.inf if opts.cache_days is None else age_cutoff(opts.cache_days)
+        evict = plan_cache_evictions(d, Inventory(d), cutoff, opts.cache_budget)
+    staging = None if opts.trash is None else open_trash(trash)
+    with Deleter(opts.jobs, trash=staging) as rm:
+        if evict is None:
+            rm.clear_dir(t.root, t.total)
+        else:
+            rm.remove_files(evict)
+    if evict is None:
+        log(f"cleared {t.name} ({human(rm.bytes)})")
+    else:
+        log(f"evicted {len(evict)} cold file(s) from {t.name} ({human(rm.bytes)})")
+
+
+def run_watch(
+    home: Path,
+    claude_dir: Path,
+    opts: Options,
+    *,
+    generic: bool,
+    desktop: bool,
+    max_size: int,
+    debounce: float,
+) -> int:
+    """Follow the cleanup targets with inotify and clean only what crosses a limit.
+
+    Each generic dir is cleaned when it grows past max_size or its oldest file
+    ages past --days; each Desktop cache dir is cleared (or, with --cache-days or
+    --cache-budget, trimmed) past max_size unless Desktop is running without
+    --force. Touched databases are compacted in one batch once they have been
+    quiet for debounce seconds. Between events the process sleeps in select(),
+    so idle CPU is nil.
+    """
+    if not sys.platform.startswith("linux"):
+        warn("--watch needs Linux inotify")
+        return 1
+    ino = Inotify()
+    trees: list[WatchedTree] = []
+    if generic:
+        trees += [
+            WatchedTree(
+                home / name,
+                name,
+                is_cache=False,
+                rules=opts.rules.for_tool(name),
+            )
+            for name in opts.rules.tools
+            if (home / name).is_dir()
+        ]
+    uid = None
+    if desktop:
+        # Caches are only cleared under a running Desktop with --force.
+        uid = claude_dir.stat().st_uid if claude_dir.is_dir() else None
+        caches = [
+            (rel, desktop_path(claude_dir, rel))
+            for rel in opts.rules.desktop_cache_dirs
+        ]
+        trees += [
+            WatchedTree(d, rel, is_cache=True)
+            for rel, d in caches
+            if d is not None and d.is_dir()
+        ]
+        dbs = [desktop_path(claude_dir, rel) for rel in opts.rules.desktop_dbs]
+        desktop_dbs = {str(db) for db in dbs if db is not None}
+        for parent in {os.path.dirname(db) for db in desktop_dbs}:
+            if Path(parent).is_dir():
+                ino.watch(parent)
+    else:
+        desktop_dbs = set()
+    for t in trees:
+        t.resync(ino)
+    log(f"watching {len(trees)} tree(s) across {len(ino.paths)} dir(s)")
+    trash = home / (opts.trash or DEFAULT_TRASH_DIR)
+    if opts.trash is not None:
+        opts = replace(opts, trash=trash)
+    quiet = replace(opts, db_maintenance=False)
+    dirty: dict[str, float] = {}
+    try:
+        while True:
+            now = time.time()
+            deadlines = [t.age_deadline(opts.days) for t in trees]
+            deadlines += [touched + debounce for touched in dirty.values()]
+            deadlines += [t.quiet_until for t in trees if t.quiet_until > now]
+            soonest = min(deadlines, default=math.inf)
+            timeout = None if math.isinf(soonest) else max(soonest - now, 0.0)
+            events = ino.read(timeout)
+            now = time.time()
+            changed: set[str] = set()
+            for mask, path in events:
+                if mask & IN_Q_OVERFLOW:
+                    warn("inotify queue overflowed; rescanning")
+                    for t in trees:
+                        t.resync(ino)
+                    changed.clear()
+                    continue
+                if db := _db_for(path, trees, desktop_dbs):
+                    dirty[db] = now
+                if mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF):
+                    changed.discard(path)
+                    for t in trees:
+                        if t.owns(path):
+                            t.drop(path)
+                else:
+                    changed.add(path)
+            # Many writes to one file arrive as one stat per wake-up.
+            for path in changed:
+                for t in trees:
+                    if t.owns(path):
+                        t.update(path, ino)
+            for t in trees:
+                if t.quiet_until > now:
+                    continue
+                # Files removed by hand lower the bar back towards max_size.
+                t.floor = min(t.floor, t.total)
+                over = t.total > max(max_size, t.floor)
+                if not over and t.age_deadline(opts.days) > now:
+                    continue
+                reason = f"{human(t.total)} > {human(max_size)}" if over else "age"
+                log(f"watch: {t.name} triggered ({reason})")
+                if t.is_cache:
+                    proc_snapshot.cache_clear()
+                    if is_desktop_running(uid) and not opts.force:
+                        warn(f"Claude Desktop is running; not clearing {t.name}")
+                    else:
+                        _clear_watched_cache(t, opts, trash)
+                else:
+                    clean_generic_dir(home, t.name, quiet)
+                t.resync(ino)
+                # Don't spin on a tree the rules cannot shrink below the limit.
+                t.settle(opts.days)
+                t.quiet_until = now + debounce
+                # Each trigger gets its own batch, so batches expire one by one.
+                open_trash.cache_clear()
+                schedule_purge(trash, opts.trash_keep)
+            due = [db for db, touched in dirty.items() if touched + debounce <= now]
+            if due:
+                for db in due:
+                    del dirty[db]
+                generic_dbs = [Path(db) for db in due if db not in desktop_dbs]
+                desktop_due = [Path(db) for db in due if db in desktop_dbs]
+                if desktop_due:
+                    proc_snapshot.cache_clear()
+                    busy = open_dbs(desktop_due)
+                    if busy is not None:
+                        desktop_due = [db for db in desktop_due if db not in busy]
+                    elif is_desktop_running() and not opts.force:
+                        desktop_due = []
+                maintain_dbs(generic_dbs + desktop_due, opts)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        ino.close()
+
+
 def self_check() -> None:
     with tempfile.TemporaryDirectory() as tmp:
         root = Path(tmp)
@@ -291,14 +4446,121 @@ def self_check() -> None:
 
         assert dir_size(root) > 0, "dir_size should be nonzero"
 
-        files, dirs = plan_generic_removals(root, days=30)
-        assert any(f.name == "x.tmp" for f in files), (
-            "plan should find junk suffix file"
+        plan = {
+            os.path.relpath(e.path, root): e for e in iter_generic_removals(root, 30)
+        }
+        assert "old.log" in plan, "plan should find junk suffix file"
+        assert plan["cache"].is_dir, "plan should find junk-named dir"
+        assert plan["cache"].size == 4, "a planned dir should carry its subtree size"
+        assert os.path.join("cache", "x.tmp") not in plan, (
+            "the dir's removal should cover its contents"
+        )
+        assert "keep.txt" not in plan, "plan should not flag unrelated files"
+
+        rules = Rules(
+            {"tools": {"t": {"junk_paths": ["a/*/c"], "skip": ["keep"]}}},
+        ).for_tool("t")
+        assert rules.junk_file("x.log.gz")
+        assert not rules.junk_file("x.gz")
+        assert rules.junk_path(os.path.join("a", "b", "c", "d"))
+        assert not rules.junk_path(os.path.join("a", "b"))
+        assert rules.skipped(os.path.join("keep", "x"))
+        assert rules.junk_dir("Cache")
+        for bad in (
+            {"tools": {"/": {}}},
+            {"tools": {"../x": {}}},
+            {"tools": ["x"]},
+            {"desktop": {"cache_dirs": "GPUCache"}},
+            {"desktop": {"cache_dir": ["GPUCache"]}},
+            {"desktop": {"cache_dirs": ["/"]}},
+            {"desktop": {"cache_dirs": ["/home/x"]}},
+            {"desktop": {"cache_dirs": ["../../.ssh"]}},
+            {"desktop": {"cache_dirs": ["."]}},
+            {"desktop": {"dbs": ["Cache/../../Cookies"]}},
+        ):
+            try:
+                Rules(bad)
+            except ValueError:
+                continue
+            msg = f"rules {bad} should be rejected"
+            raise AssertionError(msg)
+        (root / "escape").symlink_to(tmp)
+        assert desktop_path(root, "escape") is None, "symlinks must not escape"
+
+        rm = _remove_planned(root, root, [plan["cache"]], Options(jobs=2))
+        assert not junk_dir.exists(), "deleter should remove the whole tree"
+        assert (rm.files, rm.bytes) == (1, 4), "deleter should count what it removed"
+
+        bucket = TokenBucket(10_000)
+        start = time.monotonic()
+        bucket.take(500)
+        assert time.monotonic() - start >= 0.04, "token bucket should pace takes"
+
+        lru = root / "lru"
+        lru.mkdir()
+        for age, name in ((4, "keep.md"), (3, "a"), (2, "b"), (1, "c"), (0, "d")):
+            (lru / name).write_bytes(b"x" * 100)
+            then = time.time() - age * 86400
+            os.utime(lru / name, (then, then))
+        evict = plan_quota_evictions(
+            Inventory(lru),
+            250,
+            protect=compile_globs(["*.md"]),
+        )
+        assert [os.path.basename(e.path) for e in evict] == ["a", "b", "c"], (
+            "quota should evict the least recently used unprotected files"
+        )
+
+        order: list[str] = []
+        queue = WorkQueue(time.time() + 60, CostModel(root / "costs.json"))
+        for label, nbytes in (("small", 10), ("big", 10_000)):
+            run = functools.partial(order.append, label)
+            queue.run(Action("delete", label, nbytes, 1, run))
+        assert queue.drain() == 0
+        assert order == ["big", "small"], "best bytes-per-second should run first"
+
+        key = {"root": str(root), "days": 30}
+        planned = [Entry(str(root / n), 1, 1.0, False, 0, 1.0) for n in "abc"]
+        journal = Journal(root / "journal.jsonl", key)
+        journal.plan([*planned, Entry(str(root / "tree"), 5, 0.0, True, 0, 0.0)])
+        journal.done(planned[0].path)
+        journal.mark_archived([planned[1].path])
+        journal.close(finished=False)
+        resumed = Journal.load(root / "journal.jsonl", key, 60)
+        assert resumed is not None, "a fresh journal should be resumed"
+        assert [e.path for e in resumed.pending] == [
+            planned[2].path,
+            str(root / "tree"),
+        ], "done and kept paths should not be redone"
+        assert resumed.archived, "archiving should not be redone"
+        assert Journal.load(root / "journal.jsonl", {**key, "days": 7}, 60) is None, (
+            "a journal planned under other options should be dropped"
         )
-        assert any(d.name == "cache" for d in dirs), "plan should find junk-named dir"
-        assert not any(f.name == "keep.txt" for f in files), (
-            "plan should not flag unrelated files"
+
+        session = root / "session.jsonl"
+        record = {
+            "message": {"content": [{"type": "tool_result", "content": "y" * 500}]},
+        }
+        session.write_text(f"{json.dumps(record)}\nnot json\n")
+        assert compact_transcript(session, 100, gz=False, dry_run=False) > 0
+        lines = session.read_text().splitlines()
+        assert lines[1] == "not json", "unparseable lines should be kept"
+        kept = json.loads(lines[0])["message"]["content"][0]["content"]
+        assert len(kept) <= 100, "tool results should be cut to the limit"
+        ino = session.stat().st_ino
+        assert compact_transcript(session, 100, gz=False, dry_run=False) == 0, (
+            "compaction should be idempotent"
         )
+        assert session.stat().st_ino == ino, "a no-op compaction should not rewrite"
+
+        staged = root / "staged"
+        (staged / "sub").mkdir(parents=True)
+        (staged / "sub" / "f").write_text("x")
+        with Deleter(jobs=2, trash=Trash(root / "trash")) as rm:
+            rm.clear_dir(staged, 1)
+        assert not any(staged.iterdir()), "trash mode should empty the dir"
+        assert undo_trash(root / "trash") == 0
+        assert (staged / "sub" / "f").read_text() == "x", "undo should restore it"
 
         db_path = root / "t.sqlite3"
         conn = sqlite3.connect(str(db_path))
@@ -309,6 +4571,145 @@ def self_check() -> None:
         assert vacuum_db(db_path, dry_run=False, verbose=False), (
             "vacuum should succeed on valid db"
         )
+        conn = sqlite3.connect(str(db_path))
+        conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(5000)])
+        conn.commit()
+        conn.execute("DELETE FROM t")
+        conn.commit()
+        assert db_bloat(conn).free_ratio > DEFAULT_VACUUM_THRESHOLD, (
+            "deleted rows should show up as free pages"
+        )
+        conn.close()
+        bloated = db_path.stat().st_size
+        assert vacuum_db(db_path, dry_run=False, verbose=False)
+        assert db_path.stat().st_size < bloated, "bloated db should be compacted"
+
+        conn = sqlite3.connect(str(db_path))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(5000)])
+        conn.commit()
+        conn.execute("DELETE FROM t WHERE a > 0")
+        conn.commit()
+        assert vacuum_db(db_path, dry_run=False, verbose=False, into=True)
+        conn.close()
+        conn = sqlite3.connect(str(db_path))
+        rows = conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+        conn.close()
+        assert rows == 1, "VACUUM INTO swap should keep committed rows"
+        assert not list(root.glob(".t.sqlite3.vacuum-*")), "side copy is cleaned up"
+
+        shared = root / "shared.sqlite3"
+        script = (
+            "import sqlite3, sys\n"
+            "conn = sqlite3.connect(sys.argv[1], isolation_level=None)\n"
+            "conn.execute('PRAGMA journal_mode=WAL')\n"
+            "conn.execute('CREATE TABLE t (a TEXT)')\n"
+            "conn.executemany('INSERT INTO t VALUES (?)', [('x' * 100,)] * 2000)\n"
+            "conn.execute('DELETE FROM t')\n"
+            "print('ready', flush=True)\n"
+            "sys.stdin.readline()\n"
+            "conn.executemany('INSERT INTO t VALUES (?)', [('y',)] * 100)\n"
+        )
+        with subprocess.Popen(
+            [sys.executable, "-c", script, str(shared)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        ) as writer:
+            assert writer.stdout is not None
+            assert writer.stdout.readline() == "ready\n"
+            ino = shared.stat().st_ino
+            ok = vacuum_db(shared, dry_run=False, verbose=False, threshold=0, into=True)
+            writer.communicate("go\n")
+        assert ok, "vacuum should fall back to in place while a writer is attached"
+        if proc_snapshot() is not None:
+            assert shared.stat().st_ino == ino, "an open db must not be swapped"
+        conn = sqlite3.connect(str(shared))
+        status = conn.execute("PRAGMA quick_check").fetchone()[0]
+        rows = conn.execute("SELECT COUNT(*) FROM t").fetchone()[0]
+        conn.close()
+        assert (status, rows) == ("ok", 100), "the writer's later rows should survive"
+
+        note = root / "notes.txt"
+        note.write_text("keep me\n" * 100)
+        safe, _ = archive_files(
+            root,
+            [Entry.from_stat(str(note), note.stat())],
+            root / "arch",
+            Options(),
+        )
+        assert safe == [(str(note), 800)], "archived file should be reported safe"
+        with tarfile.open(next((root / "arch").glob("*.tar"))) as tar:
+            member = tar.extractfile("notes.txt.gz")
+            assert member is not None
+            assert gzip.decompress(member.read()) == note.read_bytes(), (
+                "archive member should round-trip"
+            )
+        logs = root / "logs"
+        logs.mkdir()
+        (logs / "session.txt").write_text("log")
+        dir_entry = Entry.from_stat(str(logs), logs.stat())._replace(size=3)
+        _remove_planned(root, root, [dir_entry], Options(archive=Path("logs-arch")))
+        assert not logs.exists(), "an archived junk dir should still go"
+        with tarfile.open(next((root / "logs-arch").glob("*.tar"))) as tar:
+            assert tar.getnames() == ["logs/session.txt.gz"], (
+                "files inside a junk dir should be archived before it goes"
+            )
+
+        blob = os.urandom(3 * DEDUPE_BLOCK)
+        for name, data in (("d1", blob), ("d2", blob), ("d3", blob[:-1] + b"!")):
+            (root / name).write_bytes(data)
+        (root / ".credentials.json").write_bytes(blob)
+        dups = find_duplicates(walk_tree(root), jobs=2)
+        assert [sorted(os.path.basename(e.path) for e in g) for g in dups] == [
+            ["d1", "d2"],
+        ], "only byte-identical files should group, credentials never"
+        d1, d2 = dups[0]
+        kind = _share(d1, d2, "auto", link=False)
+        assert kind != "hardlink", "auto must not hardlink without link"
+        assert os.stat(d2.path).st_nlink == 1
+
+        cache = root / "Cache_Data"
+        (cache / "index-dir").mkdir(parents=True)
+        for i, days in enumerate((1, 40, 2)):
+            for suffix in ("_0", "_s"):
+                f = cache / f"{i:016x}{suffix}"
+                f.write_bytes(b"c" * 100)
+                os.utime(f, (age_cutoff(days),) * 2)
+        evict = plan_cache_evictions(cache, Inventory(cache), age_cutoff(30), 250)
+        assert evict is not None
+        assert sorted(os.path.basename(f) for f, _ in evict) == [
+            f"{1:016x}_0",
+            f"{1:016x}_s",
+            f"{2:016x}_0",
+            f"{2:016x}_s",
+        ], "cold and over-budget cache entries should go, hot ones stay"
+        # Fields in the order Chromium's IndexMetadata::Serialize writes them.
+        index = struct.pack("<II", 0, 0) + struct.pack("<Q", SIMPLE_INDEX_MAGIC)
+        index += struct.pack("<I", 9) + struct.pack("<Q", 2)
+        index += struct.pack("<Q", 600) + struct.pack("<I", 1)
+        for key, days in ((0, 60), (2, 0)):
+            used = round((age_cutoff(days) + _CHROME_EPOCH_OFFSET) * 1e6)
+            index += struct.pack("<QqQ", key, used, 200)
+        (cache / SIMPLE_INDEX).write_bytes(index + struct.pack("<q", 0))
+        used = read_simple_index(cache)
+        assert sorted(used) == [f"{0:016x}", f"{2:016x}"], "index entries"
+        assert used[f"{0:016x}"] < age_cutoff(59) < used[f"{2:016x}"]
+        evict = plan_cache_evictions(cache, Inventory(cache), age_cutoff(30), None)
+        assert evict is not None
+        assert sorted(os.path.basename(f) for f, _ in evict) == [
+            f"{0:016x}_0",
+            f"{0:016x}_s",
+            f"{1:016x}_0",
+            f"{1:016x}_s",
+            "the-real-index",
+        ], "the index's last-used times should outrank entry file times"
+
+        tail = root / "tail.log"
+        tail.write_bytes(b"1\n2\n3")
+        with tail.open("rb") as fh:
+            assert _tail_start_lines(fh, 5, 0) == 5, "keeping 0 lines keeps nothing"
+            assert _tail_start_lines(fh, 5, 1) == 4
 
         log_path = root / "old.log"
         truncate_log(log_path, keep_lines=100, dry_run=False, verbose=False)
@@ -316,6 +4717,39 @@ def self_check() -> None:
             "truncate_log should keep exactly keep_lines"
         )
 
+        if sys.platform.startswith("linux"):
+            watched = root / "watched"
+            watched.mkdir()
+            for name, days in (("a", 3), ("b", 2), ("c", 1)):
+                (watched / name).write_text(name)
+                os.utime(watched / name, (age_cutoff(days),) * 2)
+            (watched / "keep").mkdir()
+            (watched / "keep" / "old").write_text("old")
+            os.utime(watched / "keep" / "old", (age_cutoff(9),) * 2)
+            skip = Rules({"tools": {"watched": {"skip": ["keep"]}}})
+            ino = Inotify()
+            try:
+                tree = WatchedTree(watched, "watched", False, skip.for_tool("watched"))
+                tree.resync(ino)
+                assert tree.total == 3, "a skipped subtree is not counted"
+                oldest = tree.oldest()
+                for _ in range(100):
+                    (watched / "a").touch()
+                    tree.update(str(watched / "a"), ino)
+                assert tree.oldest() > oldest, "a rewritten file is no longer oldest"
+                assert len(tree._ages) <= 2 * len(tree.files) + 64, "stale ages pile up"
+                (watched / "b").unlink()
+                tree.drop(str(watched / "b"))
+                assert tree.oldest() == (watched / "c").stat().st_mtime
+                tree.settle(0)
+                assert tree.floor == tree.total, "settle should set the size baseline"
+                assert math.isinf(tree.oldest()), "files a clean kept do not re-trigger"
+                (watched / "c").touch()
+                tree.update(str(watched / "c"), ino)
+                assert tree.oldest() == (watched / "c").stat().st_mtime
+            finally:
+                ino.close()
+
     print("self-check: PASS")
 
 
@@ -334,6 +4768,259 @@ def main() -> int:
         default=30,
         help="age threshold for generic cleanup (default: 30)",
     )
+    p.add_argument(
+        "--jobs",
+        type=parse_positive,
+        default=DEFAULT_JOBS,
+        help=f"parallel delete workers (default: {DEFAULT_JOBS})",
+    )
+    p.add_argument(
+        "--db-jobs",
+        type=parse_positive,
+        default=DEFAULT_DB_JOBS,
+        help=f"parallel SQLite maintenance workers (default: {DEFAULT_DB_JOBS})",
+    )
+    p.add_argument(
+        "--vacuum-threshold",
+        type=float,
+        default=DEFAULT_VACUUM_THRESHOLD,
+        help="free-page ratio a DB needs before it is VACUUMed; 0 = always"
+        f" (default: {DEFAULT_VACUUM_THRESHOLD})",
+    )
+    p.add_argument(
+        "--optimize",
+        action="store_true",
+        help="run PRAGMA optimize instead of REINDEX",
+    )
+    p.add_argument(
+        "--vacuum-into",
+        action="store_true",
+        help="VACUUM INTO a side copy and swap it in, holding the lock only briefly "
+        "(in place instead while another process has the DB open; Linux only, "
+        "as that check needs /proc: elsewhere every VACUUM runs in place)",
+    )
+    p.add_argument(
+        "--log-lines",
+        type=parse_positive,
+        default=DEFAULT_LOG_LINES,
+        help=f"lines to keep per Desktop log (default: {DEFAULT_LOG_LINES})",
+    )
+    p.add_argument(
+        "--log-max-bytes",
+        type=parse_size,
+        help="also cap each Desktop log to its last SIZE bytes, e.g. 10M",
+    )
+    p.add_argument(
+        "--manifest",
+        type=Path,
+        metavar="PATH",
+        help="SQLite file (relative to each home) remembering unchanged dirs "
+        "between runs (incremental scans)",
+    )
+    p.add_argument(
+        "--format",
+        choices=Reporter.FORMATS,
+        default="text",
+        help="text logs, or stream one JSON record per action (ndjson|json)",
+    )
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        help="report per-phase time, throughput, scan counters and per-DB VACUUM time",
+    )
+    p.add_argument(
+        "--trace-out",
+        type=Path,
+        help="write phase and DB spans as Chrome trace-event JSON (implies --profile)",
+    )
+    p.add_argument(
+        "--cprofile-out",
+        type=Path,
+        help="write a cProfile dump of the main thread (implies --profile)",
+    )
+    p.add_argument(
+        "--max-size",
+        type=parse_quota,
+        action="append",
+        default=[],
+        metavar="[DIR=]SIZE",
+        help="evict least-recently-used files until DIR (or every dir) fits, "
+        "e.g. .claude=5G; repeatable",
+    )
+    p.add_argument(
+        "--protect",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="never evict files matching GLOB under --max-size; repeatable",
+    )
+    p.add_argument(
+        "--archive",
+        type=Path,
+        metavar="DIR",
+        help="move old files into compressed tar archives under DIR (relative "
+        "to each home) instead of deleting them, junk dirs' contents included; "
+        "*.tmp, *.temp and *.cache files still just go",
+    )
+    p.add_argument(
+        "--archive-format",
+        choices=ARCHIVE_FORMATS,
+        default="gz",
+        help="per-member compression for --archive (default: gz)",
+    )
+    p.add_argument(
+        "--archive-keep",
+        type=int,
+        default=DEFAULT_ARCHIVE_KEEP,
+        help=f"archives kept per dir before the oldest rotate out "
+        f"(default: {DEFAULT_ARCHIVE_KEEP})",
+    )
+    p.add_argument(
+        "--rules",
+        type=Path,
+        metavar="TOML",
+        help="junk-matching rules file with per-tool sections (see Rules)",
+    )
+    p.add_argument(
+        "--cache-days",
+        type=int,
+        help="evict only Desktop cache entries unused for N days instead of "
+        "clearing the cache dirs (Chromium Simple Cache dirs)",
+    )
+    p.add_argument(
+        "--cache-budget",
+        type=parse_size,
+        help="keep at most SIZE of the most recently used entries per Desktop "
+        "cache dir instead of clearing it",
+    )
+    p.add_argument(
+        "--trash",
+        type=Path,
+        nargs="?",
+        const=DEFAULT_TRASH_DIR,
+        metavar="DIR",
+        help="rename doomed paths into a trash dir (relative to each home, default "
+        f"{DEFAULT_TRASH_DIR}) and purge them in the background later",
+    )
+    p.add_argument(
+        "--trash-keep",
+        type=float,
+        default=DEFAULT_TRASH_KEEP,
+        metavar="HOURS",
+        help="hours a trash batch can be restored before it is purged (default: "
+        f"{DEFAULT_TRASH_KEEP:g})",
+    )
+    p.add_argument(
+        "--undo",
+        action="store_true",
+        help="restore the newest trash batch to where it came from and exit",
+    )
+    p.add_argument(
+        "--purge-trash",
+        action="store_true",
+        help="delete expired trash batches now, at low priority, and exit",
+    )
+    p.add_argument(
+        "--max-io-rate",
+        type=parse_size,
+        metavar="SIZE",
+        help="cap bytes deleted, rewritten or VACUUMed per second, e.g. 20M",
+    )
+    p.add_argument(
+        "--max-ops-rate",
+        type=int,
+        metavar="N",
+        help="cap metadata operations (unlink, rename, rmdir) per second",
+    )
+    p.add_argument(
+        "--journal",
+        type=Path,
+        nargs="?",
+        const=DEFAULT_JOURNAL_DIR,
+        metavar="DIR",
+        help="log planned removals to DIR (relative to each home, default "
+        f"{DEFAULT_JOURNAL_DIR}) so an interrupted run is resumed without a rescan",
+    )
+    p.add_argument(
+        "--journal-max-age",
+        type=float,
+        default=DEFAULT_JOURNAL_MAX_AGE,
+        metavar="HOURS",
+        help="replan instead of resuming a journal older than HOURS (default: "
+        f"{DEFAULT_JOURNAL_MAX_AGE:g})",
+    )
+    p.add_argument(
+        "--compact-transcripts",
+        type=int,
+        metavar="DAYS",
+        help="rewrite session transcripts idle for DAYS days with tool results "
+        "cut to --payload-limit; newer sessions are not touched",
+    )
+    p.add_argument(
+        "--gzip-transcripts",
+        type=int,
+        metavar="DAYS",
+        help="also gzip (compacted) session transcripts idle for DAYS days",
+    )
+    p.add_argument(
+        "--payload-limit",
+        type=parse_size,
+        default=DEFAULT_PAYLOAD_LIMIT,
+        metavar="SIZE",
+        help="longest tool result kept in a compacted transcript (default: 16K)",
+    )
+    p.add_argument(
+        "--max-seconds",
+        type=float,
+        metavar="S",
+        help="stop starting work after S seconds; queued actions run best "
+        "bytes-per-second first and the rest is reported as deferred",
+    )
+    p.add_argument(
+        "--low-priority",
+        action="store_true",
+        help="run at nice 19 and, on Linux, in the idle I/O class",
+    )
+    p.add_argument(
+        "--dedupe",
+        nargs="?",
+        const="auto",
+        choices=DEDUPE_MODES,
+        help="share storage of byte-identical files left after cleanup; auto "
+        "reflinks where the filesystem can and hardlinks only Desktop extension "
+        "files otherwise, hardlink links everywhere (never DBs or credentials)",
+    )
+    p.add_argument(
+        "--watch",
+        action="store_true",
+        help="stay resident and clean targets as inotify reports them growing",
+    )
+    p.add_argument(
+        "--watch-max-size",
+        type=parse_size,
+        default=DEFAULT_WATCH_MAX_SIZE,
+        help="size that triggers cleanup of a watched dir (default: 1G)",
+    )
+    p.add_argument(
+        "--watch-debounce",
+        type=float,
+        default=DEFAULT_WATCH_DEBOUNCE,
+        help="seconds a DB must stay untouched before it is compacted (default: 300)",
+    )
+    p.add_argument(
+        "--homes",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="clean every matching home dir instead of $HOME, e.g. '/home/*'; "
+        "repeatable",
+    )
+    p.add_argument(
+        "--fleet-jobs",
+        type=int,
+        default=DEFAULT_FLEET_JOBS,
+        help=f"homes cleaned at once with --homes (default: {DEFAULT_FLEET_JOBS})",
+    )
     p.add_argument("--desktop-only", action="store_true")
     p.add_argument("--generic-only", action="store_true")
     p.add_argument(
@@ -347,32 +5034,129 @@ def main() -> int:
         self_check()
         return 0
 
-    errors = 0
     home = Path.home()
+    try:
+        rules = Rules.default() if args.rules is None else Rules.load(args.rules)
+    except ValueError as exc:
+        p.error(str(exc))
+    opts = Options(
+        days=args.days,
+        dry_run=args.dry_run,
+        verbose=args.verbose,
+        force=args.force,
+        jobs=args.jobs,
+        db_jobs=args.db_jobs,
+        vacuum_threshold=args.vacuum_threshold,
+        optimize=args.optimize,
+        vacuum_into=args.vacuum_into,
+        log_lines=args.log_lines,
+        log_max_bytes=args.log_max_bytes,
+        manifest=args.manifest,
+        quotas=tuple(args.max_size),
+        protect=DEFAULT_QUOTA_PROTECT + tuple(args.protect),
+        archive=args.archive,
+        archive_format=args.archive_format,
+        archive_keep=args.archive_keep,
+        dedupe=args.dedupe,
+        rules=rules,
+        cache_days=args.cache_days,
+        cache_budget=args.cache_budget,
+        trash=args.trash,
+        trash_keep=args.trash_keep,
+        io_rate=args.max_io_rate,
+        ops_rate=args.max_ops_rate,
+        deadline=None if args.max_seconds is None else time.time() + args.max_seconds,
+        compact_days=args.compact_transcripts,
+        gzip_days=args.gzip_transcripts,
+        payload_limit=args.payload_limit,
+        journal=args.journal,
+        journal_max_age=args.journal_max_age,
+    )
+    for flag, path in (
+        ("--archive", args.archive),
+        ("--trash", args.trash),
+        ("--journal", args.journal),
+        ("--manifest", args.manifest),
+    ):
+        if path is None:
+            continue
+        dest = os.path.realpath(home / path)
+        for name in rules.tools:
+            root = os.path.realpath(home / name)
+            if dest == root or dest.startswith(root + os.sep):
+                p.error(f"{flag} must not live inside {name}; it would be cleaned")
+    if args.watch and args.homes:
+        p.error("--watch cleans only $HOME; it cannot be combined with --homes")
+    if args.watch and args.max_seconds is not None:
+        p.error("--watch runs until stopped; it cannot be combined with --max-seconds")
+    if (args.undo or args.purge_trash) and args.homes:
+        p.error("--undo and --purge-trash act on $HOME's trash only")
+    REPORT.configure(args.format)
+    if args.low_priority:
+        lower_priority()
+    THROTTLE.configure(opts.io_rate, opts.ops_rate)
+    if args.undo or args.purge_trash:
+        trash = home / (args.trash or DEFAULT_TRASH_DIR)
+        try:
+            if args.undo:
+                return 1 if undo_trash(trash) else 0
+            return 1 if purge_trash(trash, args.trash_keep, args.jobs) else 0
+        finally:
+            REPORT.finish()
+    if args.watch:
+        try:
+            return run_watch(
+                home,
+                resolve_desktop_dir(),
+                opts,
+                generic=not args.desktop_only,
+                desktop=not args.generic_only,
+                max_size=args.watch_max_size,
+                debounce=args.watch_debounce,
+            )
+        finally:
+            REPORT.finish()
 
-    if not args.desktop_only:
-        targets = [home / name for name in GENERIC_DIRS if (home / name).is_dir()]
-        before = sum(dir_size(t) for t in targets)
-        for name in GENERIC_DIRS:
-            clean_generic_dir(home, name, args.days, args.dry_run, args.verbose)
-        after = sum(dir_size(t) for t in targets)
-        log(
-            f"Generic cleanup done. Tracked dirs before: {human(before)} -> after: {human(after)}",
-        )
-
-    if not args.generic_only:
-        errors += clean_desktop(
-            resolve_desktop_dir(),
-            args.dry_run,
-            args.verbose,
-            args.force,
-        )
-
+    if args.profile or args.trace_out or args.cprofile_out:
+        REPORT.enable_profile(trace=args.trace_out is not None)
+    profiler = cProfile.Profile() if args.cprofile_out else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        errors = _run(args, home, opts)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile_out)
+        if args.trace_out:
+            REPORT.write_trace(args.trace_out)
     if errors:
         warn(f"{errors} operation(s) failed")
         return 1
     return 0
 
 
+def _run(args: argparse.Namespace, home: Path, opts: Options) -> int:
+    generic, desktop = not args.desktop_only, not args.generic_only
+    if args.homes:
+        homes = expand_homes(args.homes)
+        if not homes:
+            warn(f"no home directories match {' '.join(args.homes)}")
+            return 1
+        errors = run_fleet(
+            homes,
+            opts,
+            generic=generic,
+            desktop=desktop,
+            jobs=args.fleet_jobs,
+        )
+    else:
+        errors = clean_home(home, opts, generic=generic, desktop=desktop).errors
+        if THROTTLE.active:
+            REPORT.add_throttle(THROTTLE.stats())
+    REPORT.finish()
+    return errors
+
+
 if __name__ == "__main__":
     raise SystemExit(main())
@@ -0,0 +1,311 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = []
+# ///
+"""Benchmark cleanup.py phases against synthetic ~/.claude + Claude Desktop trees.
+
+Each phase runs in a fresh child process so wall time, peak RSS and I/O syscall
+counts are not polluted by tree generation or by earlier phases. Results are
+written as JSON so runs from two commits can be diffed with --compare.
+
+Usage:
+    uv run cleanup_bench.py [--sizes 10k,100k,1m] [--phases scan,plan,...]
+                            [--out bench.json] [--compare old.json] [--strace]
+                            [--keep DIR]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cleanup
+
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+# Non-destructive phases first; "clean" must run last on a given tree.
+PHASES = ("scan", "dir_size", "plan", "vacuum", "truncate", "clean")
+DAY = 86400
+BLOATED_DBS = 8
+DB_ROWS = 4000
+LOG_LINES = 200_000
+EMPTY_CHAIN_DEPTH = 20
+
+
+def log(msg: str) -> None:
+    print(f"[bench] {msg}", file=sys.stderr)
+
+
+def _touch(path: Path, size: int, age_days: float, now: float) -> None:
+    path.write_bytes(b"x" * size)
+    t = now - age_days * DAY
+    os.utime(path, (t, t))
+
+
+def _bloated_db(path: Path) -> None:
+    conn = sqlite3.connect(str(path))
+    conn.execute("CREATE TABLE t (a TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?)", [("x" * 400,)] * DB_ROWS)
+    conn.commit()
+    conn.execute("DELETE FROM t WHERE rowid % 4 != 0")
+    conn.commit()
+    conn.close()
+
+
+def generate_tree(home: Path, entries: int, seed: int = 0) -> dict[str, int]:
+    """Fill home with roughly `entries` files and dirs laid out like real configs.
+
+    Mix: per-project JSONL transcripts (60%), nested cache dirs (15%), rotated
+    and compressed logs (5%), chains of empty dirs (5%), Desktop Cache_Data and
+    Code Cache entries (15%), plus a handful of bloated SQLite files and one
+    large Desktop log. Ages are spread over 90 days so --days has work to do.
+    """
+    rng = random.Random(seed)
+    now = time.time()
+    claude = home / ".claude"
+    desktop = home / ".config/Claude"
+    counts = dict.fromkeys(
+        ("transcripts", "cache", "logs", "empty_dirs", "desktop_cache", "dbs"),
+        0,
+    )
+
+    n = int(entries * 0.60)
+    projects = max(1, n // 200)
+    for p in range(projects):
+        proj = claude / "projects" / f"-home-user-src-project{p}"
+        proj.mkdir(parents=True, exist_ok=True)
+    for i in range(n):
+        proj = claude / "projects" / f"-home-user-src-project{i % projects}"
+        _touch(proj / f"{i:08x}.jsonl", rng.randint(200, 8000), rng.uniform(0, 90), now)
+    counts["transcripts"] = n
+
+    n = int(entries * 0.15)
+    for i in range(n):
+        d = claude / "statsig" / f"s{i % 50}" / "cache" / f"c{i % 7}"
+        d.mkdir(parents=True, exist_ok=True)
+        _touch(d / f"entry{i}", rng.randint(100, 4000), rng.uniform(0, 90), now)
+    counts["cache"] = n
+
+    n = int(entries * 0.05)
+    logs = claude / "debug"
+    logs.mkdir(parents=True, exist_ok=True)
+    for i in range(n):
+        suffix = rng.choice((".log", ".log.1", ".log.gz", ".log.old", ".txt"))
+        _touch(
+            logs / f"run{i}{suffix}",
+            rng.randint(500, 20000),
+            rng.uniform(0, 90),
+            now,
+        )
+    counts["logs"] = n
+
+    n = int(entries * 0.05)
+    for i in range(0, n, EMPTY_CHAIN_DEPTH):
+        d = claude / "todos" / f"chain{i}"
+        for depth in range(EMPTY_CHAIN_DEPTH):
+            d /= f"d{depth}"
+        d.mkdir(parents=True, exist_ok=True)
+    counts["empty_dirs"] = n
+
+    n = int(entries * 0.15)
+    for rel in ("Cache/Cache_Data", "Code Cache/js", "Code Cache/wasm", "GPUCache"):
+        (desktop / rel).mkdir(parents=True, exist_ok=True)
+    for i in range(n):
+        rel = "Cache/Cache_Data" if i % 3 else "Code Cache/js"
+        _touch(desktop / rel / f"{i:016x}_0", rng.randint(500, 30000), 0, now)
+    counts["desktop_cache"] = n
+
+    (desktop / "logs").mkdir(parents=True, exist_ok=True)
+    with (desktop / "logs/main.log").open("w") as fh:
+        fh.writelines(
+            f"{i} some log line with a bit of payload\n" for i in range(LOG_LINES)
+        )
+    for i in range(BLOATED_DBS):
+        _bloated_db(claude / f"state{i}.sqlite")
+    _bloated_db(desktop / "Cookies")
+    counts["dbs"] = BLOATED_DBS + 1
+    return counts
+
+
+def _run_phase(phase: str, home: Path) -> None:
+    targets = [home / name for name in cleanup.GENERIC_DIRS if (home / name).is_dir()]
+    desktop = home / ".config/Claude"
+    opts = cleanup.Options(force=True)
+    match phase:
+        case "scan":
+            for t in targets:
+                cleanup.Inventory(t)
+        case "dir_size":
+            for t in [*targets, desktop]:
+                cleanup.dir_size(t)
+        case "plan":
+            for t in targets:
+                cleanup.plan_generic_removals(t, opts.days)
+        case "vacuum":
+            dbs = [p for t in targets for p in t.glob("*.sqlite")] + [
+                desktop / "Cookies",
+            ]
+            cleanup.maintain_dbs(dbs, opts)
+        case "truncate":
+            for f in (desktop / "logs").glob("*.log"):
+                cleanup.truncate_log(f, cleanup.DEFAULT_LOG_LINES, False, False)
+        case "clean":
+            for t in targets:
+                cleanup.clean_generic_dir(home, t.name, opts)
+            cleanup.clean_desktop(desktop, opts)
+        case _:
+            msg = f"unknown phase {phase}"
+            raise ValueError(msg)
+
+
+def _io_counters() -> dict[str, int]:
+    try:
+        text = Path("/proc/self/io").read_text()
+    except OSError:
+        return {}
+    fields = dict(line.split(": ") for line in text.splitlines())
+    return {k: int(fields[k]) for k in ("syscr", "syscw") if k in fields}
+
+
+def child(phase: str, home: Path) -> None:
+    """Run one phase in this process and print its measurements as JSON."""
+    sys.stdout = Path(os.devnull).open("w")  # noqa: SIM115 - cleanup.log() chatter
+    io0 = _io_counters()
+    ru0 = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    _run_phase(phase, home)
+    seconds = time.perf_counter() - start
+    ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    io1 = _io_counters()
+    result = {
+        "seconds": round(seconds, 4),
+        "cpu_seconds": round(
+            (ru1.ru_utime - ru0.ru_utime) + (ru1.ru_stime - ru0.ru_stime),
+            4,
+        ),
+        "peak_rss_kb": ru1.ru_maxrss,
+        "ctx_switches": (ru1.ru_nvcsw - ru0.ru_nvcsw) + (ru1.ru_nivcsw - ru0.ru_nivcsw),
+        **{k: io1[k] - io0.get(k, 0) for k in io1},
+    }
+    sys.__stdout__.write(json.dumps(result) + "\n")
+
+
+def _strace_total(path: Path) -> int | None:
+    # strace -c ends with a "total" row whose 4th column is the call count.
+    for line in path.read_text().splitlines():
+        cols = line.split()
+        if cols and cols[-1] == "total":
+            return int(cols[3])
+    return None
+
+
+def measure(phase: str, home: Path, *, use_strace: bool) -> dict[str, object]:
+    cmd = [sys.executable, __file__, "--child", phase, str(home)]
+    with tempfile.NamedTemporaryFile(suffix=".strace") as trace:
+        if use_strace:
+            cmd = ["strace", "-f", "-c", "-o", trace.name, *cmd]
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        if use_strace:
+            result["syscalls"] = _strace_total(Path(trace.name))
+    return result
+
+
+def _git_rev() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+            check=True,
+        )
+    except OSError, subprocess.CalledProcessError:
+        return None
+    return out.stdout.strip()
+
+
+def compare(old: dict, new: dict) -> None:
+    for size, phases in new["results"].items():
+        for phase, cur in phases.items():
+            prev = old.get("results", {}).get(size, {}).get(phase)
+            if not prev or not prev.get("seconds"):
+                continue
+            ratio = cur["seconds"] / prev["seconds"]
+            rss = cur["peak_rss_kb"] / max(prev["peak_rss_kb"], 1)
+            flag = "  REGRESSION" if ratio > 1.10 else ""
+            print(f"{size:>5} {phase:<9} time x{ratio:.2f}  rss x{rss:.2f}{flag}")
+
+
+def main() -> int:
+    p = argparse.ArgumentParser(description=__doc__)
+    p.add_argument("--sizes", default="10k", help="comma list of 10k,100k,1m")
+    p.add_argument("--phases", default=",".join(PHASES))
+    p.add_argument("--out", type=Path, default=Path("bench.json"))
+    p.add_argument("--compare", type=Path, help="earlier results JSON to diff against")
+    p.add_argument(
+        "--strace",
+        action="store_true",
+        help="count all syscalls via strace -c",
+    )
+    p.add_argument("--keep", type=Path, help="generate trees here and keep them")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument(
+        "--child",
+        nargs=2,
+        metavar=("PHASE", "HOME"),
+        help=argparse.SUPPRESS,
+    )
+    args = p.parse_args()
+
+    if args.child:
+        child(args.child[0], Path(args.child[1]))
+        return 0
+    if args.strace and not shutil.which("strace"):
+        p.error("--strace needs strace on PATH")
+
+    phases = [ph for ph in PHASES if ph in args.phases.split(",")]
+    report: dict[str, object] = {
+        "commit": _git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "trees": {},
+        "results": {},
+    }
+    for label in args.sizes.split(","):
+        entries = SIZES[label]
+        base = args.keep or Path(tempfile.mkdtemp(prefix="cleanup-bench-"))
+        home = base / label
+        shutil.rmtree(home, ignore_errors=True)
+        log(f"generating {label} tree in {home}")
+        start = time.perf_counter()
+        report["trees"][label] = generate_tree(home, entries, args.seed)
+        log(f"generated in {time.perf_counter() - start:.1f}s")
+        results: dict[str, object] = {}
+        for phase in phases:
+            results[phase] = measure(phase, home, use_strace=args.strace)
+            log(f"{label} {phase}: {results[phase]}")
+        report["results"][label] = results
+        if args.keep is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+    args.out.write_text(json.dumps(report, indent=2) + "\n")
+    log(f"wrote {args.out}")
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), report)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())